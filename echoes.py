@@ -21,32 +21,82 @@ dictionary = 'cmudict-master/cmudict.dict'
 
 import time
 import sys
+import os
 import json
 import random
+import multiprocessing
+import collections
+import asyncio
+import contextlib
+import gc
+import signal
+import http
+import urllib.parse
+import mmap
+import struct
+import hashlib
+import hmac
+import bisect
+import heapq
+import itertools
+import threading
+import base64
+import zlib
+import zipfile
+import secrets
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class Word:
+    ''' A spelling and its pronunciation, as one byte per phoneme code.
+    '''
+    __slots__ = ('spell', 'pronna')
     def __init__(self, spell, pron):
-        self.spell = spell
-        self.pronna = ptons(pron)
+        self.spell = sys.intern(spell)
+        self.pronna = bytes(ptons(pron))
     def __str__(self):
         return self.spell + ' [' + ' '.join(ntops(self.pronna)) + ']'
 
 class Tree:
     ''' Tree ::= Tree (Word, [Tree, ...])
+
+    The children are kept in increasing rank, their ranks in the tuple
+    ranks and the subtrees in the tuple nodes.
     '''
+    __slots__ = ('root', 'ranks', 'nodes')
     def __init__(self, root):
         self.root = root
-        self.children = dict()
+        self.ranks = ()
+        self.nodes = ()
     def haschildatrank(self, rank):
-        return rank in self.children
+        i = bisect.bisect_left(self.ranks, rank)
+        return i < len(self.ranks) and self.ranks[i] == rank
     def childatrank(self, rank):
-        return self.children[rank]
-    def addword(self, word):
-        mydist = distance(self.root.pronna, word.pronna)
-        if mydist in self.children:
-            self.children[mydist].addword(word)
+        i = bisect.bisect_left(self.ranks, rank)
+        if i == len(self.ranks) or self.ranks[i] != rank:
+            raise KeyError(rank)
+        return self.nodes[i]
+    def items(self):
+        return zip(self.ranks, self.nodes)
+    def maxrank(self):
+        return self.ranks[-1] if self.ranks else 0
+    def setchildren(self, children):
+        '''Replaces the children with the (rank, subtree) pairs given.'''
+        children = sorted(children, key=lambda child: child[0])
+        self.ranks = tuple(rank for rank, child in children)
+        self.nodes = tuple(child for rank, child in children)
+    def addword(self, word, distances):
+        mydist = distances.distance(self.root.pronna, word.pronna)
+        i = bisect.bisect_left(self.ranks, mydist)
+        if i < len(self.ranks) and self.ranks[i] == mydist:
+            self.nodes[i].addword(word, distances)
         else:
-            self.children[mydist] = Tree(word)
+            self.ranks = self.ranks[:i] + (mydist,) + self.ranks[i:]
+            self.nodes = self.nodes[:i] + (Tree(word),) + self.nodes[i:]
 
 def wordtojson(word):
     return ['w', word.spell, [ntop(n) for n in word.pronna]]
@@ -56,19 +106,233 @@ def jsontoword(triple):
 
 def treetojson(tree):
     jsonchildren = dict()
-    for rank in tree.children:
-        jsonchildren[rank] = treetojson(tree.childatrank(rank))
+    for rank, child in tree.items():
+        jsonchildren[rank] = treetojson(child)
     return ['t', wordtojson(tree.root), jsonchildren]
 
 def jsontotree(pair):
-    treechildren = dict()
     jsonchildren = pair[2]
-    for rank in jsonchildren:
-        treechildren[int(rank)] = jsontotree(jsonchildren[rank])
     parsedtree = Tree(jsontoword(pair[1]))
-    parsedtree.children = treechildren
+    parsedtree.setchildren((int(rank), jsontotree(jsonchildren[rank])) for rank in jsonchildren)
     return parsedtree
 
+INDEXMAGIC = b'ECHOESIX'
+INDEXVERSION = 1
+INDEXHEADER = struct.Struct('<8sIIIIII')
+
+class TreeIndex:
+    ''' The tree as flat arrays read straight from a memory-mapped file.
+
+    Nodes are numbered in preorder, node 0 being the root.  Node i has
+    phonemes phones[pronoffset[i]:pronoffset[i+1]], spelling
+    spells[spelloffset[i]:spelloffset[i+1]] and children
+    edgechild[e] at rank edgerank[e] for e in edgeoffset[i]:edgeoffset[i+1],
+    in increasing rank.  The file is a header followed by the arrays
+    pronoffset, edgeoffset, spelloffset, edgerank, edgechild (uint32)
+    and phones, spells (bytes), all little-endian.  Given a buffer
+    holding the same bytes, it is read from there instead.
+    '''
+    def __init__(self, filelocation, buffer=None):
+        if buffer is None:
+            f = open(filelocation, 'rb')
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            f.close()
+        self.buffer = buffer
+        magic, version, nodes, edges, phones, spellbytes, reserved = \
+            INDEXHEADER.unpack_from(self.buffer)
+        if magic != INDEXMAGIC:
+            raise ValueError('{} is not an echoes index'.format(filelocation))
+        if version != INDEXVERSION:
+            raise ValueError('{} has index version {}, expected {}'.format(
+                filelocation, version, INDEXVERSION))
+        self.nodecount = nodes
+        view = memoryview(self.buffer)
+        position = INDEXHEADER.size
+        arrays = []
+        for count in (nodes+1, nodes+1, nodes+1, edges, edges):
+            arrays.append(self.uint32s(view[position:position+4*count]))
+            position += 4*count
+        self.pronoffset, self.edgeoffset, self.spelloffset, self.edgerank, self.edgechild = arrays
+        self.phones = view[position:position+phones]
+        position += phones
+        self.spells = view[position:position+spellbytes]
+    @staticmethod
+    def uint32s(view):
+        if sys.byteorder == 'little':
+            return view.cast('I')
+        swapped = array('I', bytes(view))
+        swapped.byteswap()
+        return swapped
+    def __len__(self):
+        return self.nodecount
+    def pron(self, node):
+        return self.phones[self.pronoffset[node]:self.pronoffset[node+1]]
+    def spell(self, node):
+        return str(self.spells[self.spelloffset[node]:self.spelloffset[node+1]], 'utf-8')
+    def word(self, node):
+        return Word(self.spell(node), ntops(self.pron(node)))
+    def maxrank(self, node):
+        last = self.edgeoffset[node+1]
+        return self.edgerank[last-1] if last > self.edgeoffset[node] else 0
+    def children(self, node):
+        first = self.edgeoffset[node]
+        last = self.edgeoffset[node+1]
+        return zip(self.edgerank[first:last], self.edgechild[first:last])
+
+def packindex(tree):
+    '''The bytes of the index file for tree.'''
+    nodes = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(reversed(node.nodes))
+    ids = dict((id(node), i) for i, node in enumerate(nodes))
+    pronoffset = array('I', [0])
+    edgeoffset = array('I', [0])
+    spelloffset = array('I', [0])
+    edgerank = array('I')
+    edgechild = array('I')
+    phones = bytearray()
+    spells = bytearray()
+    for node in nodes:
+        phones.extend(node.root.pronna)
+        spells.extend(node.root.spell.encode('utf-8'))
+        for rank, child in node.items():
+            edgerank.append(rank)
+            edgechild.append(ids[id(child)])
+        pronoffset.append(len(phones))
+        spelloffset.append(len(spells))
+        edgeoffset.append(len(edgerank))
+    packed = [INDEXHEADER.pack(INDEXMAGIC, INDEXVERSION, len(nodes), len(edgerank),
+                               len(phones), len(spells), 0)]
+    for uint32s in (pronoffset, edgeoffset, spelloffset, edgerank, edgechild):
+        if sys.byteorder != 'little':
+            uint32s.byteswap()
+        packed.append(uint32s.tobytes())
+    packed.append(bytes(phones))
+    packed.append(bytes(spells))
+    return b''.join(packed)
+
+def writeindex(tree, filelocation):
+    f = open(filelocation, 'wb')
+    f.write(packindex(tree))
+    f.close()
+
+def flattentree(tree):
+    '''A TreeIndex of tree held in anonymous shared memory, so that
+    processes forked afterwards all read the same pages.'''
+    packed = packindex(tree)
+    buffer = mmap.mmap(-1, len(packed))
+    buffer.write(packed)
+    return TreeIndex('<memory>', buffer)
+
+def indextotree(index):
+    nodes = [Tree(index.word(node)) for node in range(len(index))]
+    for node in range(len(index)):
+        edges = range(index.edgeoffset[node], index.edgeoffset[node+1])
+        nodes[node].ranks = tuple(index.edgerank[edge] for edge in edges)
+        nodes[node].nodes = tuple(nodes[index.edgechild[edge]] for edge in edges)
+    return nodes[0]
+
+def loadtree(filelocation):
+    '''Loads a tree saved as JSON (*.json) or as a binary index, or the
+    shards listed in a manifest (also *.json).'''
+    if filelocation.endswith('.json'):
+        f = open(filelocation)
+        loaded = json.load(f)
+        f.close()
+        if isinstance(loaded, dict):
+            return ShardedIndex(filelocation, loaded)
+        return jsontotree(loaded)
+    return TreeIndex(filelocation)
+
+class ShardedIndex:
+    ''' Lookup trees each holding the words whose pronunciations have a
+    length in a band, listed in a manifest
+
+        {"shards": [{"file": "len01-04.idx", "lengths": [1, 4], "words": 28000},
+                    {"file": "len05-up.idx", "lengths": [5, null], "words": 107118}]}
+
+    with files relative to the manifest.  Words are numbered through the
+    shards in order.  A shard whose file changes is loaded again on the
+    next refresh.
+    '''
+    def __init__(self, filelocation, manifest):
+        self.filelocation = filelocation
+        directory = os.path.dirname(filelocation)
+        self.files = [os.path.join(directory, shard['file']) for shard in manifest['shards']]
+        self.bands = [tuple(shard['lengths']) for shard in manifest['shards']]
+        self.trees = [None] * len(self.files)
+        self.stamps = [None] * len(self.files)
+        self.counts = [0] * len(self.files)
+        self.checked = 0
+        self.refresh(force=True)
+    def refresh(self, force=False):
+        '''Loads the shards whose files changed since they were loaded,
+        looking at most once a second.  Returns whether any were.'''
+        if not force and time.time() - self.checked < 1:
+            return False
+        self.checked = time.time()
+        changed = False
+        for i, location in enumerate(self.files):
+            status = os.stat(location)
+            stamp = (status.st_size, status.st_mtime_ns)
+            if stamp != self.stamps[i]:
+                self.trees[i] = loadtree(location)
+                self.stamps[i] = stamp
+                self.counts[i] = len(self.trees[i]) if isinstance(self.trees[i], TreeIndex) \
+                                 else sum(1 for word in treewords(self.trees[i]))
+                changed = True
+        return changed
+    def gap(self, i, length):
+        '''How many sounds longer or shorter than length the words of
+        shard i are at least.'''
+        low, high = self.bands[i]
+        return max(0, low - length, 0 if high is None else length - high)
+    def __len__(self):
+        return sum(self.counts)
+    def locate(self, i):
+        for shard, count in enumerate(self.counts):
+            if i < count:
+                return self.trees[shard], i
+            i -= count
+        raise IndexError(i)
+    def word(self, i):
+        shard, i = self.locate(i)
+        if isinstance(shard, TreeIndex):
+            return shard.word(i)
+        return next(itertools.islice(treewords(shard), i, None))
+    def pron(self, i):
+        return self.word(i).pronna
+
+def savetree(tree, filelocation, digest):
+    '''Saves a tree as JSON (*.json) or as a binary index, and beside it
+    the digest of the distances it was built with.'''
+    if filelocation.endswith('.json'):
+        f = open(filelocation + '.tmp', 'w')
+        json.dump(treetojson(tree), f)
+        f.close()
+    else:
+        writeindex(tree, filelocation + '.tmp')
+    os.replace(filelocation + '.tmp', filelocation)
+    savedigest(filelocation, digest)
+
+def savedigest(filelocation, digest):
+    f = open(filelocation + '.distances', 'w')
+    f.write(digest + '\n')
+    f.close()
+
+def loaddigest(filelocation):
+    '''The digest of the distances the tree file was built with, or None
+    for a tree saved before they were recorded.'''
+    if not os.path.exists(filelocation + '.distances'):
+        return None
+    f = open(filelocation + '.distances')
+    digest = f.read().strip()
+    f.close()
+    return digest
+
 def establishencoding():
     global NTOP
     global PTON
@@ -82,6 +346,9 @@ def establishencoding():
     PHONECOUNT = len(NTOP)
     NTOP.append("?")
 
+# the encoding is the same for every engine
+establishencoding()
+
 def ntops(ns):
     return [ntop(n) for n in ns]
 
@@ -113,79 +380,3346 @@ def pton(p):
     else:
         return PHONECOUNT
 
-def d(x, y):
-    ''' Measures the distance between two sounds. '''
-    return D[x][y]
-    
-def distance(A, B):
-    try:
-        m = [[],[]]
+class Distances:
+    ''' A distance matrix as lookups use it: matrix[x][y] is the cost of
+    substituting sound y for sound x, and row and column 0 (the gap) the
+    costs of deleting and inserting sounds.  Each engine has its own, and
+    while stats is a QueryStats the distances taken count into it.
+    '''
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.digest = distancesdigest(matrix)
+        self.stats = None
+        if numpy is not None:
+            self.array = numpy.array(matrix, numpy.int64)
+            # the matrix and a row for the padding of pairdistance
+            self.padded = numpy.full((len(matrix) + 1, len(matrix)), 2**24, numpy.int32)
+            self.padded[:-1] = matrix
+            self.padded[-1, 0] = 0
+        # the cheapest insertion or deletion of a sound
+        self.minindel = min(min(matrix[0][1:]), min(row[0] for row in matrix[1:]))
+    def distance(self, A, B, limit=None):
+        ''' Weighted edit distance between two pronunciations.
+
+        Given a limit, only the diagonal band of the matrix that a path
+        costing at most limit can cross is filled in, and as soon as the
+        distance is known to exceed limit, limit+1 is returned instead.
+        '''
         a = len(A)
         b = len(B)
-        for i in range(a+1):
-            m[i&1] = []
-            for j in range(b+1):
-                if i == 0:
-                    if j == 0:
-                        m[i&1].append(0)
+        insert = self.matrix[0]
+        if limit is None:
+            row = [0]
+            for j in range(b):
+                row.append(row[j] + insert[B[j]])
+            for i in range(a):
+                cost = self.matrix[A[i]]
+                delete = cost[0]
+                left = row[0] + delete
+                newrow = [left]
+                for j in range(b):
+                    y = B[j]
+                    left += insert[y]
+                    up = row[j+1] + delete
+                    if up < left:
+                        left = up
+                    diagonal = row[j] + cost[y]
+                    if diagonal < left:
+                        left = diagonal
+                    newrow.append(left)
+                row = newrow
+            if self.stats is not None:
+                self.stats.distances += 1
+                self.stats.cells += a * b
+            return row[b]
+        over = limit + 1
+        # each step off the diagonal is an insertion or deletion, so cell
+        # (i, j) is only reachable within limit if j - i is in [lo, hi]
+        delta = b - a
+        if self.minindel == 0:
+            lo, hi = -a, b
+        else:
+            steps = limit // self.minindel
+            if abs(delta) > steps:
+                if self.stats is not None:
+                    self.stats.distances += 1
+                return over
+            lo = min(0, delta) - (steps - abs(delta)) // 2
+            hi = max(0, delta) + (steps - abs(delta)) // 2
+        row = [over] * (b+1)
+        row[0] = 0
+        cells = 0
+        best = 0
+        for j in range(min(b, hi)):
+            row[j+1] = row[j] + insert[B[j]]
+            if row[j+1] > limit:
+                row[j+1] = over
+                break
+        for i in range(1, a+1):
+            cost = self.matrix[A[i-1]]
+            delete = cost[0]
+            first = max(0, i+lo)
+            last = min(b, i+hi)
+            cells += last - first + 1
+            newrow = [over] * (b+1)
+            if first == 0:
+                left = row[0] + delete
+                if left > limit:
+                    left = over
+                newrow[0] = left
+                best = left
+                first = 1
+            else:
+                left = best = over
+            for j in range(first, last+1):
+                y = B[j-1]
+                left += insert[y]
+                up = row[j] + delete
+                if up < left:
+                    left = up
+                diagonal = row[j-1] + cost[y]
+                if diagonal < left:
+                    left = diagonal
+                if left > limit:
+                    left = over
+                elif left < best:
+                    best = left
+                newrow[j] = left
+            if best > limit:
+                break
+            row = newrow
+        if self.stats is not None:
+            self.stats.distances += 1
+            self.stats.cells += cells
+        if best > limit:
+            return over
+        return row[b]
+    def batchdistance(self, mypron, codes, lengths=None):
+        ''' distance(mypron, c) for every row c of codes, a 2-D uint8 array
+        of phoneme codes, computed with NumPy for all rows at once.  Rows
+        shorter than the array are padded and their lengths given.
+
+        The matrix is filled one sound of mypron at a time.  Within a row
+        a cell is the cheapest of the cells above and diagonally above, plus
+        the insertions leading to it from the left, which is a running
+        minimum over the row.
+        '''
+        n, width = codes.shape
+        if self.stats is not None:
+            self.stats.distances += n
+            self.stats.cells += n * width * len(mypron)
+        insert = self.array[0][codes]
+        inserted = numpy.zeros((n, width+1), numpy.int64)
+        numpy.cumsum(insert, axis=1, out=inserted[:,1:])
+        row = inserted.copy()
+        base = numpy.empty_like(row)
+        for x in mypron:
+            cost = self.array[x]
+            delete = cost[0]
+            base[:,0] = row[:,0] + delete
+            numpy.minimum(row[:,1:] + delete, row[:,:-1] + cost[codes], out=base[:,1:])
+            base -= inserted
+            numpy.minimum.accumulate(base, axis=1, out=row)
+            row += inserted
+        if lengths is None:
+            return row[:,width]
+        return row[numpy.arange(n), lengths]
+    def pairdistance(self, acodes, bcodes, blengths):
+        ''' distance(a, b) for every pair of rows a of acodes and b of bcodes,
+        computed with NumPy for all pairs at once: batchdistance with a
+        different mypron for each row.  Rows of bcodes are padded with 0 and
+        their lengths given; rows of acodes are padded with len(matrix), a
+        sound that padded makes free to delete and never a substitute, so
+        that the matrix of a short a stays at its last row while the others
+        fill.
+        '''
+        n, width = bcodes.shape
+        if self.stats is not None:
+            self.stats.distances += n
+            self.stats.cells += n * width * acodes.shape[1]
+        costs = self.padded.ravel()
+        stride = self.padded.shape[1]
+        inserted = numpy.zeros((n, width+1), self.padded.dtype)
+        numpy.cumsum(costs.take(bcodes), axis=1, out=inserted[:,1:])
+        row = inserted.copy()
+        base = numpy.empty_like(row)
+        for i in range(acodes.shape[1]):
+            x = acodes[:,i].astype(numpy.intp) * stride
+            delete = costs.take(x)
+            base[:,0] = row[:,0] + delete
+            numpy.minimum(row[:,1:] + delete[:,None], row[:,:-1] + costs.take(x[:,None] + bcodes),
+                          out=base[:,1:])
+            base -= inserted
+            numpy.minimum.accumulate(base, axis=1, out=row)
+            row += inserted
+        return row[numpy.arange(n), blengths]
+
+class NearestSearch:
+    ''' A search for the words in a tree nearest to a pronunciation.
+    Iterating it yields (distance, word) in nondecreasing distance,
+    stopping after k words if k is given and at words further than
+    maxdistance if that is given.  It can be left and taken up again.
+
+    Subtrees wait in a priority queue ordered by a lower bound on the
+    distance of any word in them: a child at rank r of a node at
+    distance dist holds only words at least |dist - r| away.  Words wait
+    in the same queue under their distance, and come out once nothing
+    closer can be left.  Each node's distance is computed at most once,
+    and once k words are held, subtrees that cannot beat the k-th
+    nearest are never queued.
+
+    With bulk (and NumPy), the children of a node with many of them are
+    scored together with batchdistance when the node is expanded.
+
+    With record, the nodes expanded and the words given are noted, for
+    save; pushing the same children of the same nodes again rebuilds
+    the queue as it was, ties and all.
+    '''
+    def __init__(self, tree, distances, mypron, k=None, bulk=False, maxdistance=None,
+                 record=False):
+        if isinstance(tree, TreeIndex):
+            self.pron = tree.pron
+            self.word = tree.word
+            self.children = tree.children
+            self.maxrank = tree.maxrank
+            root = 0
+        else:
+            self.pron = lambda node: node.root.pronna
+            self.word = lambda node: node.root
+            self.children = Tree.items
+            self.maxrank = Tree.maxrank
+            root = tree
+        self.distances = distances
+        self.mypron = mypron
+        self.k = k
+        self.bulk = bulk and numpy is not None
+        self.order = itertools.count()
+        # (bound or distance, 0 for a word or 1 for a subtree, tiebreak,
+        #  node, the node's distance if already known)
+        self.queue = [(0, 1, next(self.order), root, None)]
+        self.nearest = []  # the k smallest distances so far, negated
+        self.radius = maxdistance
+        self.found = 0
+        self.expanded = [] if record else None
+        self.given = [] if record else None
+    def __iter__(self):
+        return self
+    def __next__(self):
+        queue = self.queue
+        mypron = self.mypron
+        pron = self.pron
+        maxrank = self.maxrank
+        k = self.k
+        nearest = self.nearest
+        order = self.order
+        radius = self.radius
+        distance = self.distances.distance
+        stats = self.distances.stats
+        if self.found == k:
+            raise StopIteration
+        while queue:
+            bound, kind, _, node, rootdistance = heapq.heappop(queue)
+            if kind == 0:
+                self.found += 1
+                self.radius = radius
+                if self.given is not None:
+                    self.given.append(node)
+                return bound, self.word(node)
+            if stats is not None and bound > stats.reached:
+                stats.reached = bound
+            if radius is not None and bound > radius:
+                if stats is not None:
+                    stats.pruned += 1
+                continue
+            if stats is not None:
+                stats.visited += 1
+            if rootdistance is not None:
+                if radius is not None and rootdistance > radius + maxrank(node):
+                    continue
+            elif radius is None:
+                rootdistance = distance(pron(node), mypron)
+            else:
+                limit = radius + maxrank(node)
+                rootdistance = distance(pron(node), mypron, limit)
+                if rootdistance > limit:
+                    continue
+            if self.expanded is not None:
+                self.expanded.append((node, bound, rootdistance))
+            if radius is None or rootdistance <= radius:
+                heapq.heappush(queue, (rootdistance, 0, next(order), node, None))
+                if k is not None:
+                    if len(nearest) < k:
+                        heapq.heappush(nearest, -rootdistance)
                     else:
-                        m[i&1].append(m[i&1][j-1] + d(0, B[j-1]))
-                else:
-                    if j == 0:
-                        m[i&1].append(m[(i-1)&1][j] + d(A[i-1], 0))
+                        heapq.heappushpop(nearest, -rootdistance)
+                    if len(nearest) == k:
+                        radius = -nearest[0]
+            queued = []
+            for rank, child in self.children(node):
+                childbound = max(bound, abs(rootdistance - rank))
+                if radius is None or childbound <= radius:
+                    queued.append((childbound, child))
+                elif stats is not None:
+                    stats.pruned += 1
+            if self.bulk and len(queued) >= BULKCHILDREN:
+                codes, lengths = padcodes([pron(child) for childbound, child in queued])
+                dists = self.distances.batchdistance(mypron, codes, lengths).tolist()
+            else:
+                dists = [None] * len(queued)
+            for (childbound, child), dist in zip(queued, dists):
+                heapq.heappush(queue, (childbound, 1, next(order), child, dist))
+        self.radius = radius
+        raise StopIteration
+    def save(self, number):
+        '''A recording search without k, as bytes, its nodes given by
+        number(node); restore takes it up again.  Far smaller than the
+        queue, which holds every child of every node expanded.'''
+        flat = array('i', [len(self.given)])
+        flat.extend(number(node) for node in self.given)
+        for node, bound, rootdistance in self.expanded:
+            flat.extend((number(node), bound, rootdistance))
+        return flat.tobytes()
+    @classmethod
+    def restore(cls, tree, distances, mypron, saved, node, bulk=False, maxdistance=None):
+        '''The search save gave, its nodes found by node(number).'''
+        search = cls(tree, distances, mypron, None, bulk, maxdistance, record=True)
+        flat = array('i')
+        flat.frombytes(saved)
+        search.given = [node(n) for n in flat[1:1+flat[0]]]
+        radius = search.radius
+        order = search.order
+        queue = search.queue
+        for i in range(1 + flat[0], len(flat), 3):
+            parent, bound, rootdistance = node(flat[i]), flat[i+1], flat[i+2]
+            search.expanded.append((parent, bound, rootdistance))
+            if radius is None or rootdistance <= radius:
+                queue.append((rootdistance, 0, next(order), parent, None))
+            for rank, child in search.children(parent):
+                childbound = max(bound, abs(rootdistance - rank))
+                if radius is None or childbound <= radius:
+                    queue.append((childbound, 1, next(order), child, None))
+        # drop what has come out of the queue since: the nodes expanded
+        # (the root's entry among them) and the words given
+        expanded = set(parent for parent, bound, rootdistance in search.expanded)
+        given = set(search.given)
+        search.queue = [entry for entry in queue
+                        if entry[3] not in (given if entry[1] == 0 else expanded)]
+        heapq.heapify(search.queue)
+        search.found = len(search.given)
+        return search
+
+def nearestgenie(tree, distances, mypron, k=None, bulk=False, maxdistance=None):
+    '''Yields (distance, word) for the words in tree nearest to mypron,
+    in nondecreasing distance (see NearestSearch).'''
+    return NearestSearch(tree, distances, mypron, k, bulk, maxdistance)
+
+def batchnearest(tree, distances, myprons, k=None, maxdistance=None, skip=()):
+    '''[list(nearestgenie(tree, distances, mypron, k, False, maxdistance)) for mypron
+    in myprons], found together (with NumPy).  Each query takes the steps
+    of its own NearestSearch, so it gets the same matches in the same
+    order, ties and all; but the queries step in rounds, one node each,
+    with the distances of a round computed at once by pairdistance, and
+    each node's pronunciation and children are read from the tree once
+    for the whole batch, however many queries reach it.  Rounds of few
+    distances, as when only a few queries are left, are computed one at
+    a time like NearestSearch does.  Words whose keys are in skip (the
+    tombstones) are passed over: they are not found and do not count
+    toward k, so each query still stops at k live matches.'''
+    if isinstance(tree, TreeIndex):
+        pron, word, children, maxrank = tree.pron, tree.word, tree.children, tree.maxrank
+        root = 0
+    else:
+        pron = lambda node: node.root.pronna
+        word = lambda node: node.root
+        children, maxrank = Tree.items, Tree.maxrank
+        root = tree
+    read = dict()
+    def readnode(node):
+        if node not in read:
+            read[node] = (pron(node), list(children(node)), maxrank(node))
+        return read[node]
+    qcodes, qlengths = padcodes(myprons)
+    qcodes[numpy.arange(qcodes.shape[1]) >= qlengths[:,None]] = len(distances.matrix)
+    queues = [[(0, 1, 0, root, None)] for mypron in myprons]
+    orders = [itertools.count(1) for mypron in myprons]
+    nearests = [[] for mypron in myprons]
+    radii = [maxdistance] * len(myprons)
+    found = [[] for mypron in myprons]
+    stepping = list(range(len(myprons)))
+    while stepping:
+        # each query pops its queue until it gives up or needs a distance
+        asked = []
+        for q in stepping:
+            queue = queues[q]
+            radius = radii[q]
+            while queue and (k is None or len(found[q]) < k):
+                bound, kind, _, node, rootdistance = heapq.heappop(queue)
+                if kind == 0:
+                    found[q].append((bound, word(node)))
+                elif radius is None or bound <= radius:
+                    asked.append((q, node, bound))
+                    break
+        if not asked:
+            break
+        if len(asked) >= BATCHPAIRS:
+            ids = numpy.array([q for q, node, bound in asked])
+            prons = [readnode(node)[0] for q, node, bound in asked]
+            lengths = numpy.fromiter(map(len, prons), numpy.intp, len(prons))
+            ends = numpy.cumsum(lengths)
+            codes = numpy.zeros((len(prons), lengths.max()), numpy.uint8)
+            codes[numpy.arange(len(prons)).repeat(lengths),
+                  numpy.arange(ends[-1]) - (ends - lengths).repeat(lengths)] = \
+                numpy.frombuffer(b''.join(prons), numpy.uint8)
+            dists = distances.pairdistance(qcodes[ids], codes, lengths).tolist()
+        else:
+            dists = []
+            for q, node, bound in asked:
+                nodepron, nodechildren, noderank = readnode(node)
+                dists.append(distances.distance(nodepron, myprons[q], None if radii[q] is None
+                                                else radii[q] + noderank))
+        stepping = []
+        for (q, node, bound), rootdistance in zip(asked, dists):
+            stepping.append(q)
+            nodepron, nodechildren, noderank = read[node]
+            queue, order, nearest, radius = queues[q], orders[q], nearests[q], radii[q]
+            # as NearestSearch: too far to hold a match or a child within radius
+            if radius is not None and rootdistance > radius + noderank:
+                continue
+            if ((radius is None or rootdistance <= radius) and
+                    not (skip and wordkey(word(node)) in skip)):
+                heapq.heappush(queue, (rootdistance, 0, next(order), node, None))
+                if k is not None:
+                    if len(nearest) < k:
+                        heapq.heappush(nearest, -rootdistance)
+                    else:
+                        heapq.heappushpop(nearest, -rootdistance)
+                    if len(nearest) == k:
+                        radius = radii[q] = -nearest[0]
+            for rank, child in nodechildren:
+                childbound = max(bound, abs(rootdistance - rank))
+                if radius is None or childbound <= radius:
+                    heapq.heappush(queue, (childbound, 1, next(order), child, None))
+    return found
+
+# fewer distances than this in a round of batchnearest are cheaper to
+# compute one at a time
+BATCHPAIRS = 24
+
+def batchlookup(echoes, myprons, n, maxdistance=None):
+    '''[list(searchgenie(echoes, mypron, n, maxdistance)) for mypron in
+    myprons], with batchnearest where it applies: the tree engine on one
+    tree, with NumPy, and enough queries to fill its rounds.'''
+    if (echoes.engine != 'tree' or isinstance(echoes.tree, ShardedIndex) or numpy is None or
+            len(myprons) < BATCHPAIRS):
+        return [list(searchgenie(echoes, mypron, n, maxdistance)) for mypron in myprons]
+    results = []
+    tombstones = echoes.tombstones
+    for found, mypron in zip(batchnearest(echoes.tree, echoes.distances, myprons, n, maxdistance,
+                                          tombstones), myprons):
+        if echoes.overlay is not None:
+            found = heapq.merge(found, nearestgenie(echoes.overlay, echoes.distances, mypron,
+                                                    n + len(tombstones), False, maxdistance),
+                                key=lambda match: match[0])
+        if tombstones:
+            found = (match for match in found if wordkey(match[1]) not in tombstones)
+        results.append(list(itertools.islice(found, n)))
+    return results
+
+# fewer children than this are cheaper to score one at a time
+BULKCHILDREN = 16
+
+def padcodes(prons):
+    '''The prons as a 2-D uint8 array padded with zeros, and their lengths.'''
+    lengths = numpy.array([len(p) for p in prons])
+    codes = numpy.zeros((len(prons), max(lengths, default=0)), numpy.uint8)
+    for i, p in enumerate(prons):
+        codes[i,:len(p)] = list(p)
+    return codes, lengths
+
+def treewords(tree):
+    '''Every word of a Tree, in preorder.'''
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        yield node.root
+        stack.extend(reversed(node.nodes))
+
+class LengthBuckets:
+    ''' Every pronunciation of a tree for scanning with batchdistance:
+    for each length, the node numbers (or word numbers for a Tree) and
+    an array of their phoneme codes, one row each.
+    '''
+    def __init__(self, tree):
+        self.buckets = []
+        if isinstance(tree, TreeIndex):
+            self.word = tree.word
+            offsets = numpy.frombuffer(tree.pronoffset, numpy.uint32).astype(numpy.int64)
+            phones = numpy.frombuffer(tree.phones, numpy.uint8)
+            lengths = numpy.diff(offsets)
+            for length in numpy.unique(lengths):
+                ids = numpy.flatnonzero(lengths == length)
+                codes = phones[offsets[ids][:,None] + numpy.arange(length)]
+                self.buckets.append((int(length), ids, codes))
+        else:
+            words = list(treewords(tree))
+            self.word = words.__getitem__
+            bylength = dict()
+            for i, word in enumerate(words):
+                bylength.setdefault(len(word.pronna), []).append(i)
+            for length in sorted(bylength):
+                ids = numpy.array(bylength[length])
+                codes = numpy.frombuffer(b''.join(words[i].pronna for i in ids),
+                                         numpy.uint8).reshape(len(ids), length)
+                self.buckets.append((length, ids, codes))
+
+def scangenie(buckets, distances, mypron, k=None, maxdistance=None):
+    '''Yields (distance, word) like nearestgenie, by scoring the whole
+    dictionary with batchdistance.  Lengths are scanned closest first,
+    and once k words are held, lengths too far off to beat the k-th
+    nearest are skipped.'''
+    tostats = distances.stats
+    found = [(numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.int64))]
+    radius = maxdistance
+    for length, ids, codes in sorted(buckets.buckets, key=lambda bucket: abs(bucket[0] - len(mypron))):
+        if radius is not None and abs(length - len(mypron)) * distances.minindel > radius:
+            if tostats is not None:
+                tostats.pruned += len(ids)
+            continue
+        if tostats is not None:
+            tostats.visited += len(ids)
+            tostats.reached = max(tostats.reached, abs(length - len(mypron)) * distances.minindel)
+        dists = distances.batchdistance(mypron, codes)
+        if radius is not None:
+            within = dists <= radius
+            dists = dists[within]
+            ids = ids[within]
+        found.append((dists, ids))
+        if k is not None:
+            dists = numpy.concatenate([f[0] for f in found])
+            nodes = numpy.concatenate([f[1] for f in found])
+            if len(dists) > k:
+                # ties for the k-th place go to the first words, as in
+                # the order they are yielded in
+                kth = numpy.partition(dists, k-1)[k-1]
+                below = numpy.flatnonzero(dists < kth)
+                tied = numpy.flatnonzero(dists == kth)
+                tied = tied[numpy.argsort(nodes[tied], kind='stable')[:k - len(below)]]
+                keep = numpy.concatenate([below, tied])
+                dists = dists[keep]
+                nodes = nodes[keep]
+            found = [(dists, nodes)]
+            if len(dists) == k:
+                radius = dists.max()
+    dists = numpy.concatenate([f[0] for f in found])
+    nodes = numpy.concatenate([f[1] for f in found])
+    order = numpy.lexsort((nodes, dists))
+    if k is not None:
+        order = order[:k]
+    for i in order:
+        yield int(dists[i]), buckets.word(int(nodes[i]))
+
+class PhoneTrie:
+    ''' The pronunciations of a tree in sorted order, so that the words
+    under any prefix sit together: walking the list is a depth-first walk
+    of a trie of phonemes.  With reverse, pronunciations are kept back to
+    front, which shares endings (rhymes) instead of beginnings.
+    '''
+    def __init__(self, tree, reverse=False):
+        if isinstance(tree, TreeIndex):
+            count = len(tree)
+            pron = tree.pron
+            self.word = tree.word
+        else:
+            words = list(treewords(tree))
+            count = len(words)
+            pron = lambda i: words[i].pronna
+            self.word = words.__getitem__
+        step = -1 if reverse else 1
+        entries = sorted((tuple(pron(i))[::step], i) for i in range(count))
+        self.prons = [entry[0] for entry in entries]
+        self.ids = [entry[1] for entry in entries]
+        self.reverse = reverse
+    def __len__(self):
+        return len(self.prons)
+
+def triewalk(trie, distances, mypron, k=None, radius=None, above=-1):
+    '''The (distance, word number) pairs of a PhoneTrie with distances in
+    (above, radius], or the k nearest of them, sorted.  One row of the
+    distance matrix is kept per phoneme of the current prefix, so words
+    sharing a prefix share its rows, and once every cell of a row is over
+    radius (which shrinks to the k-th nearest so far) the words under
+    that prefix are skipped.'''
+    tostats = distances.stats
+    if trie.reverse:
+        mypron = mypron[::-1]
+    prons = trie.prons
+    ids = trie.ids
+    b = len(mypron)
+    matrix = distances.matrix
+    insert = matrix[0]
+    row = [0]
+    for j in range(b):
+        row.append(row[j] + insert[mypron[j]])
+    rows = [row]
+    path = ()
+    found = []
+    nearest = []  # the k smallest distances so far, negated
+    i = 0
+    while i < len(prons):
+        pron = prons[i]
+        depth = 0
+        shared = min(len(pron), len(rows) - 1)
+        while depth < shared and pron[depth] == path[depth]:
+            depth += 1
+        del rows[depth+1:]
+        path = pron
+        while depth < len(pron):
+            row = rows[depth]
+            cost = matrix[pron[depth]]
+            delete = cost[0]
+            left = row[0] + delete
+            newrow = [left]
+            for j in range(b):
+                y = mypron[j]
+                left += insert[y]
+                up = row[j+1] + delete
+                if up < left:
+                    left = up
+                diagonal = row[j] + cost[y]
+                if diagonal < left:
+                    left = diagonal
+                newrow.append(left)
+            rows.append(newrow)
+            depth += 1
+            if tostats is not None:
+                tostats.visited += 1
+                tostats.cells += b
+            if radius is not None and min(newrow) > radius:
+                break
+        else:
+            depth = None
+        if depth is not None:
+            # skip every pronunciation starting with this prefix
+            skip = bisect.bisect_right(prons, pron[:depth] + (PHONECOUNT + 1,), i)
+            if tostats is not None:
+                tostats.pruned += skip - i
+            i = skip
+            continue
+        dist = rows[-1][b]
+        if tostats is not None:
+            tostats.distances += 1
+        same = i + 1
+        while same < len(prons) and prons[same] == pron:
+            same += 1
+        if above < dist and (radius is None or dist <= radius):
+            for node in ids[i:same]:
+                found.append((dist, node))
+                if k is not None:
+                    if len(nearest) < k:
+                        heapq.heappush(nearest, -dist)
                     else:
-                        m[i&1].append(min(
-                            m[i&1][j-1] + d(0, B[j-1]),
-                            m[(i-1)&1][j] + d(A[i-1], 0),
-                            m[(i-1)&1][j-1] + d(A[i-1], B[j-1])))
-    except IndexError:
-        print('IndexError at {} compared to {}'.format(A, B))
-        raise IndexError
-    return m[a&1][b]
-
-def seekergenie(tree, mypron, tolerance):
-    rootdistance = distance(tree.root.pronna, mypron)
-    if rootdistance == tolerance:
-        yield tree.root
-    for rank in range(rootdistance-tolerance, rootdistance+tolerance+1):
-        if tree.haschildatrank(rank):
-            for ans in seekergenie(tree.childatrank(rank), mypron, tolerance):
-                yield ans
-
-def lookupgenie(mypron):
-    '''A generator generating best matches'''
-    tolerance = 0
+                        heapq.heappushpop(nearest, -dist)
+                    if len(nearest) == k:
+                        radius = -nearest[0]
+        i = same
+    found.sort()
+    if tostats is not None and radius is not None:
+        tostats.reached = max(tostats.reached, radius)
+    return found[:k]
+
+def triegenie(trie, distances, mypron, k=None, maxdistance=None):
+    '''Yields (distance, word) like nearestgenie, from a PhoneTrie.
+    Without k or maxdistance the trie is walked again for each band of
+    distances, each twice as wide as the one before.'''
+    if k is not None or maxdistance is not None:
+        for dist, node in triewalk(trie, distances, mypron, k, maxdistance):
+            yield dist, trie.word(node)
+        return
+    above = -1
+    radius = 16
+    left = len(trie)
+    while left:
+        for dist, node in triewalk(trie, distances, mypron, None, radius, above):
+            yield dist, trie.word(node)
+            left -= 1
+        above = radius
+        radius *= 2
+
+def phonetrie(echoes):
+    trie = echoes.tries.get(echoes.engine)
+    if trie is None or trie.tree is not echoes.tree:
+        trie = echoes.tries[echoes.engine] = PhoneTrie(echoes.tree, echoes.engine == 'reversetrie')
+        trie.tree = echoes.tree
+    return trie
+
+# a gram is kept as a number, six bits to a sound, in 64 bits
+maxgram = 10
+
+class NgramIndex:
+    ''' For each run of gram consecutive sounds (counting the ends of a
+    word as sounds), the numbers of the words containing it, numbered as
+    in LengthBuckets.  All lists are kept sorted in one array, grams in
+    keys and where each list starts in offsets.  With collapse, stressed
+    vowels count as their unstressed forms.
+    '''
+    def __init__(self, tree, gram=2, collapse=False):
+        if not 1 <= gram <= maxgram:
+            raise ValueError('gram must be from 1 to {}'.format(maxgram))
+        if isinstance(tree, TreeIndex):
+            count = len(tree)
+            pron = tree.pron
+            self.word = tree.word
+        else:
+            words = list(treewords(tree))
+            count = len(words)
+            pron = lambda i: words[i].pronna
+            self.word = words.__getitem__
+        self.gram = gram
+        self.fold = list(range(PHONECOUNT + 1))
+        if collapse:
+            for n, p in enumerate(NTOP):
+                if p.endswith('1'):
+                    self.fold[n] = PTON[p[:-1]]
+        prons = [pron(i) for i in range(count)]
+        self.codes, self.lengths = padcodes(prons)
+        grams = []
+        ids = []
+        self.counts = numpy.zeros(count, numpy.int64)
+        for i, p in enumerate(prons):
+            found = self.grams(p)
+            grams.extend(found)
+            ids.extend([i] * len(found))
+            self.counts[i] = len(found)
+        grams = numpy.array(grams, numpy.int64)
+        ids = numpy.array(ids, numpy.uint32)
+        order = numpy.lexsort((ids, grams))
+        grams = grams[order]
+        self.ids = ids[order]
+        self.keys, self.offsets = numpy.unique(grams, return_index=True)
+        self.offsets = numpy.append(self.offsets, len(grams))
+    def grams(self, pron):
+        '''The distinct grams of pron, each as one number.'''
+        sounds = [0] + [self.fold[x] for x in pron] + [0]
+        found = set()
+        for i in range(max(1, len(sounds) - self.gram + 1)):
+            key = 0
+            for x in sounds[i:i+self.gram]:
+                key = key * 64 + x
+            found.add(key)
+        return sorted(found)
+    def __len__(self):
+        return len(self.lengths)
+    def candidates(self, mypron, count, maxdistance=None, minindel=0):
+        '''The numbers of the count words sharing the most grams with
+        mypron for their length (by the Dice coefficient), leaving out
+        words no nearer than maxdistance allows by their length alone
+        (each sound more or less costing at least minindel).'''
+        grams = numpy.array(self.grams(mypron), numpy.int64)
+        at = numpy.searchsorted(self.keys, grams)
+        known = at < len(self.keys)
+        at = at[known][self.keys[at[known]] == grams[known]]
+        postings = [self.ids[self.offsets[a]:self.offsets[a+1]] for a in at.tolist()]
+        shared = numpy.bincount(numpy.concatenate(postings + [numpy.zeros(0, numpy.uint32)]),
+                                minlength=len(self))
+        apart = numpy.abs(self.lengths - len(mypron))
+        score = 2 * shared / (len(grams) + self.counts) - 1e-3 * apart
+        if maxdistance is not None:
+            score[apart * minindel > maxdistance] = -numpy.inf
+        chosen = numpy.flatnonzero(score > -numpy.inf)
+        if len(chosen) > count:
+            chosen = chosen[numpy.argpartition(-score[chosen], count-1)[:count]]
+        return chosen
+
+def ngramgenie(index, distances, mypron, k=None, maxdistance=None, candidates=2000):
+    '''Yields (distance, word) like nearestgenie, but only among the
+    candidates words picked by NgramIndex.candidates, so some of the
+    nearest words may be missed.'''
+    tostats = distances.stats
+    chosen = index.candidates(mypron, candidates, maxdistance, distances.minindel)
+    if tostats is not None:
+        tostats.visited += len(chosen)
+        tostats.pruned += len(index) - len(chosen)
+    lengths = index.lengths[chosen]
+    dists = distances.batchdistance(mypron, index.codes[chosen, :lengths.max(initial=0)], lengths)
+    if maxdistance is not None:
+        within = dists <= maxdistance
+        dists = dists[within]
+        chosen = chosen[within]
+    order = numpy.lexsort((chosen, dists))
+    if k is not None:
+        order = order[:k]
+    for i in order:
+        yield int(dists[i]), index.word(int(chosen[i]))
+
+def ngramindex(echoes):
+    ngrams = echoes.ngrams
+    if ngrams is None or ngrams.tree is not echoes.tree or \
+       (ngrams.gram, ngrams.collapse) != (echoes.gramsize, echoes.collapsestress):
+        ngrams = echoes.ngrams = NgramIndex(echoes.tree, echoes.gramsize, echoes.collapsestress)
+        ngrams.tree = echoes.tree
+        ngrams.collapse = echoes.collapsestress
+    return ngrams
+
+class PivotTable:
+    ''' The distance from every word of a tree to a few pivot words
+    chosen far apart, as an array with a row per word (numbered as in
+    LengthBuckets) and a column per pivot.  Since distance is a metric,
+    a word w is at least |d(w, p) - d(q, p)| from a query q for every
+    pivot p, which rules most words out without computing their
+    distance.  Distances are stored as uint16, beyond which they are
+    capped (which keeps the bounds valid).
+    '''
+    def __init__(self, tree, pivots, table):
+        if isinstance(tree, TreeIndex):
+            self.pron = tree.pron
+            self.word = tree.word
+        else:
+            words = list(treewords(tree))
+            self.pron = lambda i: words[i].pronna
+            self.word = words.__getitem__
+        self.pivots = pivots
+        self.table = table
+    @staticmethod
+    def build(tree, distances, count=32, seed=0, candidates=1000):
+        '''Picks count pivots from a sample of candidates, each as far as
+        possible from the ones before, and tabulates their distances.'''
+        buckets = LengthBuckets(tree)
+        words = sum(len(ids) for length, ids, codes in buckets.buckets)
+        pron = (lambda i: list(tree.pron(i))) if isinstance(tree, TreeIndex) \
+               else (lambda i: buckets.word(i).pronna)
+        def column(pivot):
+            dists = numpy.zeros(words, numpy.int64)
+            for length, ids, codes in buckets.buckets:
+                dists[ids] = distances.batchdistance(pron(pivot), codes)
+            return dists
+        rand = random.Random(seed)
+        sample = numpy.array(rand.sample(range(words), min(candidates, words)))
+        pivots = [int(sample[0])]
+        columns = [column(pivots[0])]
+        nearest = columns[0][sample]
+        while len(pivots) < min(count, words):
+            pivot = int(sample[numpy.argmax(nearest)])
+            pivots.append(pivot)
+            columns.append(column(pivot))
+            nearest = numpy.minimum(nearest, columns[-1][sample])
+        table = numpy.minimum(numpy.stack(columns, axis=1), 2**16 - 1).astype(numpy.uint16)
+        return PivotTable(tree, pivots, table)
+    def save(self, filelocation, stamp):
+        # written whole beside it, then moved in: workers may save the
+        # same table at once, and a reader must never see half of one
+        temporary = '{}.{}.tmp'.format(filelocation, os.getpid())
+        f = open(temporary, 'wb')
+        numpy.savez(f, pivots=numpy.array(self.pivots), table=self.table,
+                    stamp=numpy.array(json.dumps(stamp)))
+        f.close()
+        os.replace(temporary, filelocation)
+    @staticmethod
+    def load(tree, filelocation, stamp):
+        '''The table saved for this stamp, or None (also for a file that
+        cannot be read).'''
+        if not os.path.exists(filelocation):
+            return None
+        try:
+            saved = numpy.load(filelocation)
+            if str(saved['stamp']) != json.dumps(stamp):
+                return None
+            return PivotTable(tree, saved['pivots'].tolist(), saved['table'])
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile, zlib.error):
+            return None
+
+def graphworkerinit(index, matrix):
+    global GRAPHINDEX
+    global GRAPHDISTANCES
+    GRAPHINDEX = index
+    GRAPHDISTANCES = Distances(matrix)
+
+def graphworker(task):
+    return linkwords(GRAPHINDEX, GRAPHDISTANCES, task)
+
+def linkwords(index, distances, task):
+    '''The nearest words to each word of task among members, or without
+    members among the candidates NgramIndex.candidates finds, as a row
+    of degree neighbours (padded with -1) and a row of distances.'''
+    ids, degree, candidates, members = task
+    neighbours = numpy.full((len(ids), degree), -1, numpy.int64)
+    dists = numpy.zeros((len(ids), degree), numpy.int64)
+    for row, i in enumerate(ids):
+        pron = index.codes[i, :index.lengths[i]].tolist()
+        if members is None:
+            chosen = index.candidates(pron, candidates + 1)
+        else:
+            chosen = members
+        chosen = chosen[chosen != i]
+        lengths = index.lengths[chosen]
+        found = distances.batchdistance(pron, index.codes[chosen, :lengths.max(initial=0)], lengths)
+        nearest = numpy.lexsort((chosen, found))[:degree]
+        neighbours[row, :len(nearest)] = chosen[nearest]
+        dists[row, :len(nearest)] = found[nearest]
+    return neighbours, dists
+
+class NeighbourGraph:
+    ''' A graph linking each word of a tree (numbered as in LengthBuckets)
+    to at most twice degree words near it, for approximate lookups by
+    beam search.  Above it are smaller layers, each over a random sample of
+    the layer below one degree-th of its size, with each word linked to
+    its nearest in the layer; a search walks down them from the single
+    word of the top layer to start the beam near the query.
+
+    layers[0] is an array with a row of neighbours per word, padded
+    with -1; layers[1:] are (words, neighbours) array pairs.
+    '''
+    def __init__(self, tree, layers):
+        if isinstance(tree, TreeIndex):
+            self.word = tree.word
+            self.codes, self.lengths = padcodes([tree.pron(i) for i in range(len(tree))])
+        else:
+            words = list(treewords(tree))
+            self.word = words.__getitem__
+            self.codes, self.lengths = padcodes([word.pronna for word in words])
+        self.layers = layers
+        self.neighbours = [row[row >= 0].tolist() for row in layers[0]]
+        # each upper layer as a dict from word to its neighbours
+        self.upper = [dict(zip(words.tolist(), [row[row >= 0].tolist() for row in rows]))
+                      for words, rows in layers[1:]]
+        self.entry = int(layers[-1][0][0]) if len(layers) > 1 else 0
+    @staticmethod
+    def build(tree, distances, degree=16, candidates=200, levels=2, seed=0, jobs=1,
+              chunksize=500, progress=5.0):
+        '''Links each word to the degree nearest of the candidates words
+        NgramIndex.candidates finds for it and adds each link the other
+        way, keeping the twice degree nearest; the words of each upper layer
+        are linked to their nearest in the layer exactly.'''
+        index = NgramIndex(tree)
+        count = len(index)
+        rand = numpy.random.default_rng(seed)
+        layerwords = [numpy.arange(count)]
+        while len(layerwords) <= levels and len(layerwords[-1]) > 1:
+            members = layerwords[-1]
+            layerwords.append(numpy.sort(rand.choice(members, max(1, len(members) // degree),
+                                                     replace=False)))
+        tasks = []
+        for level, members in enumerate(layerwords):
+            tasks.extend((members[start:start+chunksize], degree, candidates,
+                          None if level == 0 else members)
+                         for start in range(0, len(members), chunksize))
+        total = sum(len(members) for members in layerwords)
+        starttime = lastreport = time.time()
+        results = []
+        pool = None
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs, initializer=graphworkerinit,
+                                        initargs=(index, distances.matrix))
+            found = pool.imap(graphworker, tasks)
+        else:
+            found = (linkwords(index, distances, task) for task in tasks)
+        try:
+            for result in found:
+                results.append(result)
+                if progress and time.time() - lastreport >= progress:
+                    lastreport = time.time()
+                    print('  {d}/{n} words linked, {t:.1f} seconds'.format(
+                        d=sum(len(task[0]) for task in tasks[:len(results)]), n=total,
+                        t=lastreport-starttime))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        layers = []
+        for members in layerwords:
+            chunks = results[:-(-len(members) // chunksize)]
+            del results[:len(chunks)]
+            layers.append((members, numpy.concatenate([chunk[0] for chunk in chunks]),
+                           numpy.concatenate([chunk[1] for chunk in chunks])))
+        members, neighbours, dists = layers[0]
+        # add every link the other way, then keep the nearest of each word's
+        source = numpy.repeat(numpy.arange(count), degree)
+        target = neighbours.ravel()
+        weight = dists.ravel()
+        kept = target >= 0
+        source, target, weight = source[kept], target[kept], weight[kept]
+        source, target, weight = (numpy.concatenate([source, target]),
+                                  numpy.concatenate([target, source]),
+                                  numpy.concatenate([weight, weight]))
+        order = numpy.lexsort((target, weight, source))
+        source, target = source[order], target[order]
+        # a link found both ways is kept once
+        pairs, first = numpy.unique(source * count + target, return_index=True)
+        first = numpy.sort(first)
+        source, target = source[first], target[first]
+        # as in HNSW, twice as many on the bottom layer: fewer words are
+        # left with no links to them
+        starts = numpy.searchsorted(source, numpy.arange(count))
+        rank = numpy.arange(len(source)) - starts[source]
+        kept = rank < 2 * degree
+        bottom = numpy.full((count, 2 * degree), -1, numpy.int64)
+        bottom[source[kept], rank[kept]] = target[kept]
+        return NeighbourGraph(tree, [bottom] + [(members, neighbours)
+                                                for members, neighbours, dists in layers[1:]])
+    def save(self, filelocation, stamp):
+        arrays = {'layer0': self.layers[0], 'stamp': numpy.array(json.dumps(stamp))}
+        for level, (words, rows) in enumerate(self.layers[1:], 1):
+            arrays['words{}'.format(level)] = words
+            arrays['layer{}'.format(level)] = rows
+        # moved in whole, as PivotTable.save does
+        temporary = '{}.{}.tmp'.format(filelocation, os.getpid())
+        f = open(temporary, 'wb')
+        numpy.savez(f, **arrays)
+        f.close()
+        os.replace(temporary, filelocation)
+    @staticmethod
+    def load(tree, filelocation, stamp):
+        '''The graph saved for this stamp, or None (also for a file that
+        cannot be read).'''
+        if not os.path.exists(filelocation):
+            return None
+        try:
+            saved = numpy.load(filelocation)
+            if str(saved['stamp']) != json.dumps(stamp):
+                return None
+            layers = [saved['layer0']]
+            while 'layer{}'.format(len(layers)) in saved:
+                layers.append((saved['words{}'.format(len(layers))],
+                               saved['layer{}'.format(len(layers))]))
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile, zlib.error):
+            return None
+        return NeighbourGraph(tree, layers)
+
+def graphgenie(graph, distances, mypron, k=None, maxdistance=None, beam=32):
+    '''Yields (distance, word) like nearestgenie, but only among the
+    words a beam search of the NeighbourGraph reaches, so some of the
+    nearest words may be missed.  The search keeps the beam nearest
+    words seen (at least k), and stops once none of their neighbours
+    left to look at is nearer than the furthest of them.'''
+    tostats = distances.stats
+    def score(nodes):
+        if not nodes:
+            return []
+        lengths = graph.lengths[nodes]
+        return distances.batchdistance(mypron, graph.codes[nodes, :lengths.max()],
+                                       lengths).tolist()
+    current = graph.entry
+    dist = score([current])[0]
+    for links in reversed(graph.upper):
+        moved = True
+        # a word alone in its layer has no links there
+        while moved and links[current]:
+            found, neighbour = min(zip(score(links[current]), links[current]))
+            moved = found < dist
+            if moved:
+                current, dist = neighbour, found
+    width = max(beam, k or 0)
+    seen = {current}
+    queued = [(dist, current)]
+    nearest = [(-dist, -current)]  # the width nearest so far, negated
+    while queued:
+        dist, node = heapq.heappop(queued)
+        if len(nearest) == width and dist > -nearest[0][0]:
+            break
+        if tostats is not None:
+            tostats.visited += 1
+        fresh = [neighbour for neighbour in graph.neighbours[node] if neighbour not in seen]
+        if not fresh:
+            continue
+        seen.update(fresh)
+        for neighbour, found in zip(fresh, score(fresh)):
+            full = len(nearest) == width
+            if full and found > -nearest[0][0]:
+                continue
+            heapq.heappush(queued, (found, neighbour))
+            if full:
+                heapq.heappushpop(nearest, (-found, -neighbour))
+            else:
+                heapq.heappush(nearest, (-found, -neighbour))
+    found = sorted((-dist, -node) for dist, node in nearest)
+    if tostats is not None:
+        tostats.reached = max(tostats.reached, found[-1][0])
+    found = [(dist, node) for dist, node in found if maxdistance is None or dist <= maxdistance]
+    for dist, node in found[:k]:
+        yield dist, graph.word(node)
+
+def pivotgenie(table, distances, mypron, k=None, maxdistance=None):
+    '''Yields (distance, word) like nearestgenie, from a PivotTable.
+    Words are taken in increasing order of their lower bound, and a word
+    is yielded once no word left can be closer.'''
+    tostats = distances.stats
+    distance = distances.distance
+    position = numpy.array([distance(table.pron(p), mypron) for p in table.pivots])
+    lower = numpy.abs(table.table.astype(numpy.int64) - position).max(axis=1)
+    order = numpy.argsort(lower, kind='stable').tolist()
+    lower = lower.tolist()
+    radius = maxdistance
+    waiting = []
+    nearest = []  # the k smallest distances so far, negated
+    found = 0
+    for visited, i in enumerate(order):
+        bound = lower[i]
+        while waiting and waiting[0][0] <= bound:
+            dist, j = heapq.heappop(waiting)
+            yield dist, table.word(j)
+            found += 1
+            if found == k:
+                return
+        if radius is not None and bound > radius:
+            if tostats is not None:
+                tostats.pruned += len(order) - visited
+            break
+        if tostats is not None:
+            tostats.visited += 1
+            tostats.reached = max(tostats.reached, bound)
+        dist = distance(table.pron(i), mypron, radius)
+        if radius is not None and dist > radius:
+            continue
+        heapq.heappush(waiting, (dist, i))
+        if k is not None:
+            if len(nearest) < k:
+                heapq.heappush(nearest, -dist)
+            else:
+                heapq.heappushpop(nearest, -dist)
+            if len(nearest) == k:
+                radius = -nearest[0]
+    while waiting and found != k:
+        dist, j = heapq.heappop(waiting)
+        yield dist, table.word(j)
+        found += 1
+
+def graphstamp(echoes):
+    return {'tree': treestamp(echoes.treefile), 'distances': echoes.distances.digest}
+
+def neighbourgraph(echoes):
+    '''The NeighbourGraph saved beside the tree file for the same tree
+    and distances, or one built (and saved there if possible) with the
+    default settings of `echoes.py graph'.'''
+    graph = echoes.graph
+    if graph is not None and graph.tree is echoes.tree:
+        return graph
+    location = echoes.treefile + '.graph.npz'
+    graph = NeighbourGraph.load(echoes.tree, location, graphstamp(echoes))
+    if graph is None:
+        print('building the neighbour graph (`echoes.py graph\' builds it ahead)', file=sys.stderr)
+        graph = NeighbourGraph.build(echoes.tree, echoes.distances, progress=0)
+        try:
+            graph.save(location, graphstamp(echoes))
+        except OSError:
+            pass
+    graph.tree = echoes.tree
+    echoes.graph = graph
+    return graph
+
+def pivottable(echoes):
+    '''The PivotTable of the engine's tree, read from beside the tree
+    file if one was saved there for the same tree and distances, or
+    built (and saved there if possible).'''
+    table = echoes.pivots
+    if table is not None and table.tree is echoes.tree:
+        return table
+    stamp = {'tree': treestamp(echoes.treefile),
+             'distances': echoes.distances.digest, 'pivots': echoes.pivotcount}
+    location = echoes.treefile + '.pivots.npz'
+    table = PivotTable.load(echoes.tree, location, stamp)
+    if table is None:
+        starttime = time.time()
+        table = PivotTable.build(echoes.tree, echoes.distances, echoes.pivotcount)
+        print('built a table of {p} pivots in {t:.1f} seconds'.format(
+            p=len(table.pivots), t=time.time()-starttime), file=sys.stderr)
+        try:
+            table.save(location, stamp)
+        except OSError:
+            pass
+    table.tree = echoes.tree
+    echoes.pivots = table
+    return table
+
+class QueryStats:
+    ''' Counts of the work done by lookups: distance() calls (one per
+    candidate for batchdistance) and matrix cells filled, tree nodes (or
+    scanned words) whose distance was taken versus those ruled out by a
+    bound, the furthest bound the search reached, and time per phase.
+    '''
+    def __init__(self):
+        self.queries = 0
+        self.distances = 0
+        self.cells = 0
+        self.visited = 0
+        self.pruned = 0
+        self.reached = 0
+        self.phases = collections.OrderedDict()
+    @contextlib.contextmanager
+    def phase(self, name):
+        starttime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - starttime
+    def add(self, other):
+        for name in ('queries', 'distances', 'cells', 'visited', 'pruned'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.reached = max(self.reached, other.reached)
+        for name, seconds in other.phases.items():
+            self.phases[name] = self.phases.get(name, 0) + seconds
+    def asdict(self):
+        return {'queries': self.queries, 'distances': self.distances, 'cells': self.cells,
+                'visited': self.visited, 'pruned': self.pruned, 'reached': self.reached,
+                'phases': dict(self.phases)}
+    def __str__(self):
+        considered = self.visited + self.pruned
+        return ('{d} distances, {c} cells; {v} nodes visited, {p} pruned ({r:.0%}); '
+                'searched to distance {reached}; {phases}').format(
+            d=self.distances, c=self.cells, v=self.visited, p=self.pruned,
+            r=self.pruned / considered if considered else 0, reached=self.reached,
+            phases=', '.join('{} {:.4f}s'.format(name, seconds)
+                             for name, seconds in self.phases.items()))
+
+@contextlib.contextmanager
+def instrument(echoes, stats=None):
+    '''Counts the lookups echoes makes inside the with block into stats
+    (a new QueryStats by default), which it gives; an enclosing
+    instrument block gets the counts too.'''
+    distances = echoes.distances
+    previous = distances.stats
+    distances.stats = QueryStats() if stats is None else stats
+    try:
+        yield distances.stats
+    finally:
+        if previous is not None:
+            previous.add(distances.stats)
+        distances.stats = previous
+
+def measuredquery(echoes, mypron, n, maxdistance=None, measure=False):
+    '''The n best matches, as (distance, word), and the QueryStats of
+    finding them if measure is set or echoes has queryhooks (None
+    otherwise).'''
+    if not (measure or echoes.queryhooks):
+        return list(lookupgenie(echoes, mypron, n, maxdistance)), None
+    with instrument(echoes) as stats:
+        stats.queries = 1
+        with stats.phase('first match'):
+            genie = lookupgenie(echoes, mypron, n, maxdistance)
+            matches = list(itertools.islice(genie, 1))
+        with stats.phase('other matches'):
+            matches.extend(genie)
+    for hook in echoes.queryhooks:
+        hook(stats)
+    return matches, stats
+
+def lookupgenie(echoes, mypron, n=None, maxdistance=None):
+    '''A generator generating best matches, as (distance, word)'''
+    if isinstance(echoes.tree, ShardedIndex) and echoes.tree.refresh():
+        echoes.generation += 1
+    if echoes.cache is not None and n is not None:
+        return iter(echoes.cache.lookup(echoes, mypron, n, maxdistance))
+    return searchgenie(echoes, mypron, n, maxdistance)
+
+def shardworkerinit(treelocation, matrix):
+    global SHARDINDEX
+    global SHARDDISTANCES
+    establishencoding()
+    SHARDINDEX = loadtree(treelocation)
+    SHARDDISTANCES = Distances(matrix)
+
+def shardworker(shard, mypron, k, maxdistance, bulkchildren, measure):
+    '''The k nearest words of a shard within maxdistance, and the
+    QueryStats of finding them as a dict if measure is set.'''
+    distances = SHARDDISTANCES
+    SHARDINDEX.refresh()
+    distances.stats = QueryStats() if measure else None
+    found = list(nearestgenie(SHARDINDEX.trees[shard], distances, mypron, k, bulkchildren,
+                              maxdistance))
+    stats, distances.stats = distances.stats, None
+    return found, stats.asdict() if measure else None
+
+def shardexecutor(echoes):
+    if echoes.shardpool is None:
+        import concurrent.futures
+        echoes.shardpool = concurrent.futures.ProcessPoolExecutor(echoes.shardjobs,
+            initializer=shardworkerinit, initargs=(echoes.treefile, echoes.distances.matrix))
+    return echoes.shardpool
+
+def shardgenie(echoes, mypron, k=None, maxdistance=None):
+    '''Yields (distance, word) like nearestgenie from the ShardedIndex of
+    echoes, merging the matches of its shards in order.  A shard is only
+    searched once the matches yielded reach the distance its words'
+    difference in length alone must cost.
+
+    Given k, and shardjobs above 1, the shards are searched at the same
+    time on a pool of processes instead, and those the k-th nearest
+    match found so far rules out are called off.
+    '''
+    shards = echoes.tree
+    distances = echoes.distances
+    tostats = distances.stats
+    bounds = sorted((shards.gap(i, len(mypron)) * distances.minindel, i)
+                    for i in range(len(shards.trees)))
+    if maxdistance is not None:
+        if tostats is not None:
+            tostats.pruned += sum(shards.counts[i] for bound, i in bounds if bound > maxdistance)
+        bounds = [(bound, i) for bound, i in bounds if bound <= maxdistance]
+    if k is not None and echoes.shardjobs > 1:
+        yield from pooledshardgenie(echoes, mypron, k, maxdistance, bounds)
+        return
+    heads = []
+    order = itertools.count()
+    found = 0
     while True:
-        seeker = seekergenie(tree, mypron, tolerance)
-        for ans in seeker:
-            yield ans
-        tolerance += 1
+        while bounds and (not heads or bounds[0][0] <= heads[0][0]):
+            bound, i = bounds.pop(0)
+            search = nearestgenie(shards.trees[i], distances, mypron, k, echoes.bulk, maxdistance)
+            for dist, word in itertools.islice(search, 1):
+                heapq.heappush(heads, (dist, next(order), word, search))
+        if not heads:
+            break
+        dist, position, word, search = heapq.heappop(heads)
+        yield dist, word
+        found += 1
+        if found == k:
+            break
+        for dist, word in itertools.islice(search, 1):
+            heapq.heappush(heads, (dist, next(order), word, search))
+    if tostats is not None:
+        tostats.pruned += sum(shards.counts[i] for bound, i in bounds)
 
-def lookupbest(mypron, n):
+def pooledshardgenie(echoes, mypron, k, maxdistance, bounds):
+    import concurrent.futures
+    shards = echoes.tree
+    tostats = echoes.distances.stats
+    executor = shardexecutor(echoes)
+    pending = dict((executor.submit(shardworker, i, mypron, k, maxdistance, echoes.bulk,
+                                    tostats is not None), (bound, i))
+                   for bound, i in bounds)
+    results = dict()
+    nearest = []
+    while pending:
+        done, waiting = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            bound, i = pending.pop(future)
+            results[i], stats = future.result()
+            if stats is not None:
+                for name in ('distances', 'cells', 'visited', 'pruned'):
+                    setattr(tostats, name, getattr(tostats, name) + stats[name])
+                tostats.reached = max(tostats.reached, stats['reached'])
+            nearest = heapq.nsmallest(k, nearest + [dist for dist, word in results[i]])
+        if len(nearest) == k:
+            for future, (bound, i) in list(pending.items()):
+                if bound > nearest[-1] and future.cancel():
+                    del pending[future]
+                    if tostats is not None:
+                        tostats.pruned += shards.counts[i]
+    merged = heapq.merge(*[results[i] for bound, i in bounds if i in results],
+                         key=lambda match: match[0])
+    return itertools.islice(merged, k)
+
+def searchgenie(echoes, mypron, n=None, maxdistance=None, engine=None):
+    '''The matches of echoes, as (distance, word), found by its engine
+    or the one named.'''
+    # a removed word may take the place of a match, so ask for as many more
+    tombstones = echoes.tombstones
+    distances = echoes.distances
+    engine = engine or echoes.engine
+    k = None if n is None else n + len(tombstones)
+    if isinstance(echoes.tree, ShardedIndex):
+        found = shardgenie(echoes, mypron, k, maxdistance)
+    elif engine == 'scan':
+        found = scangenie(lengthbuckets(echoes), distances, mypron, k, maxdistance)
+    elif engine == 'pivots':
+        found = pivotgenie(pivottable(echoes), distances, mypron, k, maxdistance)
+    elif engine in ('trie', 'reversetrie'):
+        found = triegenie(phonetrie(echoes), distances, mypron, k, maxdistance)
+    elif engine == 'ngrams':
+        found = ngramgenie(ngramindex(echoes), distances, mypron, k, maxdistance,
+                           echoes.candidates)
+    elif engine == 'graph':
+        found = graphgenie(neighbourgraph(echoes), distances, mypron, k, maxdistance, echoes.beam)
+    else:
+        found = nearestgenie(echoes.tree, distances, mypron, k, echoes.bulk, maxdistance)
+    if echoes.overlay is None and not tombstones:
+        return found
+    if echoes.overlay is not None:
+        found = heapq.merge(found, nearestgenie(echoes.overlay, distances, mypron, k, False,
+                                                maxdistance),
+                            key=lambda match: match[0])
+    if tombstones:
+        found = (match for match in found if wordkey(match[1]) not in tombstones)
+    return itertools.islice(found, n)
+
+class LookupCache:
+    ''' The results of recent lookups, keyed by the lookup settings, the
+    pronunciation and the distance limit.  Each entry keeps its matches
+    in order and, for the tree engine, the search that found them, so a
+    lookup wanting more matches than were kept carries the search on.
+    The least recently used entries are dropped beyond maxentries
+    entries or (roughly) maxbytes bytes.  Everything is dropped when the
+    words of the engine looking up change.
+    '''
+    def __init__(self, maxentries=10000, maxbytes=None):
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.resumed = 0
+        self.evicted = 0
+        self.tree = None
+        self.generation = None
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+    @staticmethod
+    def entrybytes(entry):
+        # a rough figure: a match holds a tuple and a Word, a queued
+        # search step a tuple
+        results, search, complete, size = entry
+        frontier = len(getattr(search, 'queue', ()))
+        return 200 + 250 * len(results) + 100 * frontier
+    def lookup(self, echoes, mypron, n, maxdistance=None):
+        if self.tree is not echoes.tree or self.generation != echoes.generation:
+            self.clear()
+            self.tree = echoes.tree
+            self.generation = echoes.generation
+        key = (echoes.engine, tuple(mypron), maxdistance)
+        # taken out while the search goes on, so a lookup that fails
+        # leaves neither the entry nor its bytes behind
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[3]
+        if entry is None:
+            self.misses += 1
+            entry = [[], None, False, 0]
+            if echoes.engine in ('tree', 'pivots'):
+                entry[1] = searchgenie(echoes, mypron, None, maxdistance)
+        elif len(entry[0]) >= n or entry[2]:
+            self.hits += 1
+        elif entry[1] is not None:
+            self.resumed += 1
+        else:
+            # a scan or a trie walk has nothing to carry on with
+            self.misses += 1
+        results, search, complete = entry[:3]
+        if len(results) < n and not complete:
+            if search is None:
+                results[:] = searchgenie(echoes, mypron, n, maxdistance)
+                complete = len(results) < n
+            else:
+                results.extend(itertools.islice(search, n - len(results)))
+                if len(results) < n:
+                    complete = True
+                    search = None
+        entry = [results, search, complete, 0]
+        entry[3] = self.entrybytes(entry)
+        self.bytes += entry[3]
+        self.entries[key] = entry
+        while self.entries and (len(self.entries) > self.maxentries or
+                                (self.maxbytes is not None and self.bytes > self.maxbytes)):
+            oldkey, old = self.entries.popitem(last=False)
+            self.bytes -= old[3]
+            self.evicted += 1
+        return results[:n]
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits,
+                'misses': self.misses, 'resumed': self.resumed, 'evicted': self.evicted}
+
+class CursorStore:
+    ''' Continuations of paged lookups, each held under a random token
+    until it is taken or ttl seconds have passed.  The oldest are dropped
+    beyond maxentries of them or (roughly) maxbytes bytes.
+    '''
+    def __init__(self, maxentries=10000, ttl=600, maxbytes=None):
+        self.maxentries = maxentries
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.expired = 0
+        self.evicted = 0
+    def put(self, value, size):
+        now = time.time()
+        while self.entries and next(iter(self.entries.values()))[0] < now:
+            self.bytes -= self.entries.popitem(last=False)[1][2]
+            self.expired += 1
+        token = secrets.token_urlsafe(12)
+        self.entries[token] = (now + self.ttl, value, size)
+        self.bytes += size
+        while len(self.entries) > self.maxentries or (
+                self.maxbytes is not None and self.bytes > self.maxbytes and len(self.entries) > 1):
+            self.bytes -= self.entries.popitem(last=False)[1][2]
+            self.evicted += 1
+        return token
+    def take(self, token):
+        '''The value held under token, given up, or None if there is none
+        (or no longer).'''
+        entry = self.entries.pop(token, None)
+        if entry is None:
+            return None
+        self.bytes -= entry[2]
+        return entry[1] if entry[0] >= time.time() else None
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.bytes,
+                'expired': self.expired, 'evicted': self.evicted}
+
+class LookupCursor:
+    ''' A lookup read a page at a time: its search, left where the last
+    page stopped, and how many matches have been read.  With the tree
+    engine the search is a recording NearestSearch, and what is saved of
+    it is not its queue but the nodes it has expanded (with their bounds
+    and distances) and the words it has given, from which restore builds
+    the queue again.
+    '''
+    def __init__(self, echoes, mypron, maxdistance, search=None, offset=0):
+        self.echoes = echoes
+        self.mypron = mypron
+        self.maxdistance = maxdistance
+        self.search = search
+        self.offset = offset
+        self.found = None
+        if search is not None:
+            self.found = (match for match in search
+                          if wordkey(match[1]) not in echoes.tombstones)
+        self.tree = echoes.tree
+        self.generation = echoes.generation
+    def page(self, n):
+        if self.found is None:
+            # nothing to carry on from, so each page searches again for
+            # the matches read and its own, and skips the matches read
+            found = searchgenie(self.echoes, self.mypron, self.offset + n, self.maxdistance)
+            matches = list(itertools.islice(found, self.offset, None))
+        else:
+            matches = list(itertools.islice(self.found, n))
+        self.offset += len(matches)
+        return matches
+    def bytes(self):
+        return 200 + 100 * len(getattr(self.search, 'queue', ()))
+
+def savablesearch(echoes):
+    '''Whether searches of echoes can be saved: only the tree engine's,
+    on one tree without words added since it was built.'''
+    return (echoes.engine == 'tree' and echoes.overlay is None and
+            not isinstance(echoes.tree, ShardedIndex))
+
+def treenodes(echoes):
+    '''The nodes of the Tree of echoes in preorder and their numbers,
+    for saving searches of it.'''
+    if echoes.nodenumbers is None or echoes.nodenumbers[0] is not echoes.tree:
+        nodes = []
+        stack = [echoes.tree]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(reversed(node.nodes))
+        echoes.nodenumbers = (echoes.tree, nodes, {id(node): i for i, node in enumerate(nodes)})
+    return echoes.nodenumbers
+
+def cursorstamp(echoes):
+    '''What a saved continuation must have been made with: the engine,
+    cost profile, distances, tree file and journal.'''
+    status = os.stat(echoes.treefile)
+    return [echoes.engine, echoes.profile, echoes.distances.digest[:16], status.st_size,
+            status.st_mtime_ns, echoes.journalentries]
+
+def savecursor(echoes, cursor):
+    '''A continuation holding the whole state of cursor, as a string.'''
+    header = {'stamp': cursorstamp(echoes), 'profile': echoes.profile, 'pron': cursor.mypron,
+              'maxdistance': cursor.maxdistance, 'offset': cursor.offset}
+    saved = b''
+    if cursor.search is not None:
+        header['queue'] = True
+        if isinstance(echoes.tree, TreeIndex):
+            saved = cursor.search.save(int)
+        else:
+            numbers = treenodes(echoes)[2]
+            saved = cursor.search.save(lambda node: numbers[id(node)])
+    data = zlib.compress(json.dumps(header).encode('ascii') + b'\n' + saved)
+    if echoes.cursorkey is not None:
+        data = cursorsignature(echoes.cursorkey, data) + data
+    return 'c' + base64.urlsafe_b64encode(data).decode('ascii')
+
+class ContinuationError(ValueError):
+    '''A continuation that is not one, has expired or no longer fits the
+    words, distances or engine.'''
+
+def cursorsignature(key, data):
+    return hmac.new(key, data, hashlib.sha256).digest()[:16]
+
+def readcontinuation(continuation, key=None):
+    '''The header and saved search of a continuation savecursor made
+    (signed with key, if one is given), or ContinuationError.'''
+    try:
+        data = base64.urlsafe_b64decode(continuation[1:].encode('ascii'))
+        if key is not None:
+            signature, data = data[:16], data[16:]
+            if not hmac.compare_digest(signature, cursorsignature(key, data)):
+                raise ContinuationError('not a continuation')
+        line, _, saved = zlib.decompress(data).partition(b'\n')
+        header = json.loads(line)
+    except (ValueError, zlib.error):
+        raise ContinuationError('not a continuation')
+    if not isinstance(header, dict) or not isinstance(header.get('profile'), (str, type(None))):
+        raise ContinuationError('not a continuation')
+    return header, saved
+
+def cursorprofile(continuation, key=None):
+    '''The cost profile a continuation was made with (None for none),
+    for serve to find the engine to take it up with.'''
+    return readcontinuation(continuation, key)[0]['profile']
+
+def loadcursor(echoes, continuation):
+    '''The LookupCursor savecursor saved in continuation.  Anything else
+    raises ContinuationError, however it came to be.'''
+    header, saved = readcontinuation(continuation, echoes.cursorkey)
+    isint = lambda value: type(value) is int and value >= 0
+    if not (isinstance(header.get('pron'), list) and header['pron'] and
+            all(isint(p) and p < len(echoes.distances.matrix) for p in header['pron']) and
+            (header.get('maxdistance') is None or isint(header['maxdistance'])) and
+            isint(header.get('offset'))):
+        raise ContinuationError('not a continuation')
+    if header.get('stamp') != cursorstamp(echoes):
+        raise ContinuationError('the continuation belongs to another engine, tree or version of it')
+    search = None
+    tree = echoes.tree
+    if header.get('queue'):
+        if isinstance(tree, TreeIndex):
+            node, nodes = int, len(tree)
+        else:
+            node, nodes = treenodes(echoes)[1].__getitem__, len(treenodes(echoes)[1])
+        flat = array('i')
+        if len(saved) % flat.itemsize:
+            raise ContinuationError('not a continuation')
+        flat.frombytes(saved)
+        given = flat[0] if flat else -1
+        if (not 0 <= given <= len(flat) - 1 or (len(flat) - 1 - given) % 3 or
+                not all(0 <= number < nodes for number in flat[1:1+given]) or
+                not all(0 <= number < nodes for number in flat[1+given::3])):
+            raise ContinuationError('not a continuation')
+        search = NearestSearch.restore(tree, echoes.distances, header['pron'], saved, node,
+                                       echoes.bulk, header['maxdistance'])
+    return LookupCursor(echoes, header['pron'], header['maxdistance'], search, header['offset'])
+
+def lookuppage(echoes, mypron, n, maxdistance=None, continuation=None):
+    '''A page of n matches, as (distance, word), and the continuation to
+    ask for the next page with (None after the last page), from the
+    start of a lookup or from a continuation (which sets mypron and
+    maxdistance).  With a CursorStore in echoes.cursors the search is
+    kept in it, and the continuation is an 's' and its token; otherwise
+    it is saved whole in the continuation, starting with 'c'.'''
+    cursors = echoes.cursors
+    if continuation is None:
+        search = None
+        if savablesearch(echoes):
+            search = NearestSearch(echoes.tree, echoes.distances, mypron, None, echoes.bulk,
+                                   maxdistance, record=True)
+        cursor = LookupCursor(echoes, mypron, maxdistance, search)
+    elif continuation.startswith('s'):
+        cursor = None if cursors is None else cursors.take(continuation[1:])
+        if cursor is None:
+            raise ContinuationError('the continuation has expired or was used already')
+        if (cursor.echoes is not echoes or cursor.tree is not echoes.tree or
+                cursor.generation != echoes.generation):
+            raise ContinuationError('the words or distances have changed since the continuation')
+    elif continuation.startswith('c'):
+        cursor = loadcursor(echoes, continuation)
+    else:
+        raise ContinuationError('not a continuation')
+    matches = cursor.page(n)
+    if len(matches) < n:
+        return matches, None
+    if cursors is not None:
+        return matches, 's' + cursors.put(cursor, cursor.bytes())
+    return matches, savecursor(echoes, cursor)
+
+def lengthbuckets(echoes):
+    buckets = echoes.buckets
+    if buckets is None or buckets.tree is not echoes.tree:
+        buckets = echoes.buckets = LengthBuckets(echoes.tree)
+        buckets.tree = echoes.tree
+    return buckets
+
+# 'tree' walks the tree, 'scan' scores every word with NumPy, 'pivots'
+# rules words out by their distances to a few pivot words, 'trie' and
+# 'reversetrie' share distance rows between words with the same beginning
+# or ending, and 'ngrams' only scores words sharing the most runs of
+# sounds with the query and 'graph' only those a walk of a neighbour
+# graph reaches, so these two may miss some of the nearest
+approximateengines = {'ngrams', 'graph'}
+
+def lookupbest(echoes, mypron, n):
     try:
-        genie = lookupgenie(mypron)
-        candidates = []
         starttime = time.time()
-        for i in range(n):
-            try:
-                word = next(genie)
-                print('  {} | {}' . format(distance(word.pronna, mypron), word))
-            except StopIteration:
-                break
+        matches, stats = measuredquery(echoes, mypron, n, measure=echoes.showstats)
+        for dist, word in matches:
+            print('  {} | {}' . format(dist, word))
         stoptime = time.time()
         print ('{t} seconds'.format(t=stoptime-starttime))
+        if stats is not None:
+            print (stats)
+        if echoes.cache is not None:
+            print ('cache: {hits} hits, {resumed} resumed, {misses} misses, {entries} entries'.format(**echoes.cache.stats()))
         print ()
     except (KeyboardInterrupt, EOFError):
         print ('Lookup aborted.')
 
-def loaddistances(filelocation):
+def distancesdigest(matrix):
+    return hashlib.sha1(json.dumps(matrix).encode('ascii')).hexdigest()
+
+def checkdistances(matrix):
+    '''Raises ValueError unless matrix is a metric on the sounds and the
+    gap (sound 0, whose row holds the costs of deleting and inserting
+    sounds): the tree walks prune by the triangle inequality, so a tree
+    built with anything else loses matches.  Different sounds may be
+    0 apart, which merges them.'''
+    size = len(NTOP)
+    names = ['gap'] + NTOP[1:]
+    if len(matrix) != size or any(len(row) != size for row in matrix):
+        raise ValueError('distances must be a {n}x{n} matrix'.format(n=size))
+    for a, row in enumerate(matrix):
+        for b, cost in enumerate(row):
+            if not isinstance(cost, int) or cost < 0:
+                raise ValueError('distances must be whole numbers of at least 0, '
+                                 'not {c} from {a} to {b}'.format(c=cost, a=names[a], b=names[b]))
+            if cost != matrix[b][a]:
+                raise ValueError('distances are not symmetric: {a} to {b} is {c}, back is {d}'.format(
+                    a=names[a], b=names[b], c=cost, d=matrix[b][a]))
+        if row[a] != 0:
+            raise ValueError('the distance from {a} to itself is not 0'.format(a=names[a]))
+    if numpy is not None:
+        # every way a to b to c at once; the loop below only names a break
+        square = numpy.array(matrix, numpy.int64)
+        if not (square > (square[:, :, None] + square[None, :, :]).min(axis=1)).any():
+            return
+    for b, rowb in enumerate(matrix):
+        for a, rowa in enumerate(matrix):
+            ab = rowa[b]
+            for c in range(size):
+                if rowa[c] > ab + rowb[c]:
+                    raise ValueError('distances break the triangle inequality: {a} to {c} is {ac}, '
+                                     'but {a} to {b} to {c} is {abc}'.format(
+                                         a=names[a], b=names[b], c=names[c],
+                                         ac=rowa[c], abc=ab + rowb[c]))
+
+def closedistances(matrix):
+    '''The metric closure of a symmetric matrix: each distance lowered
+    to the cheapest way there through other sounds (Floyd-Warshall).'''
+    closed = [list(row) for row in matrix]
+    size = len(closed)
+    for b in range(size):
+        rowb = closed[b]
+        for rowa in closed:
+            ab = rowa[b]
+            for c in range(size):
+                if ab + rowb[c] < rowa[c]:
+                    rowa[c] = ab + rowb[c]
+    return closed
+
+def readdistances(filelocation):
+    '''The distance matrix in a file, checked by checkdistances.'''
     f = open(filelocation)
-    global D
-    D = json.load(f)
+    matrix = json.load(f)
     f.close()
+    try:
+        checkdistances(matrix)
+    except ValueError as error:
+        raise ValueError('{}: {}'.format(filelocation, error))
+    return matrix
 
-def main():
-    print('''    Echoes Copyright (C) 2018 pennzht
+def defaulttree():
+    return 'tree.idx' if os.path.exists('tree.idx') else 'tree.json'
+
+# named cost profiles: profiles/NAME.json holds a distance matrix, and the
+# tree for it is kept in indexes/DIGEST/ by the matrix's digest, so that a
+# changed matrix gets a tree of its own
+profiles = 'profiles'
+indexes = 'indexes'
+
+def profilelocation(name):
+    return os.path.join(profiles, name + '.json')
+
+def profiletree(name):
+    '''The tree file of the cost profile name, which may not be built
+    yet, and its distances file.'''
+    distlocation = profilelocation(name)
+    if not os.path.exists(distlocation):
+        raise ValueError('there is no cost profile {n} (no {f})'.format(n=name, f=distlocation))
+    digest = distancesdigest(readdistances(distlocation))
+    return os.path.join(indexes, digest, 'tree.idx'), distlocation
+
+def profileindex(name, jobs=None):
+    '''The tree and distances files of the cost profile name, building
+    the tree for its distances from the dictionary if there is none yet
+    (on jobs processes, by default all).'''
+    treelocation, distlocation = profiletree(name)
+    if not os.path.exists(treelocation):
+        distances = Distances(readdistances(distlocation))
+        starttime = time.time()
+        print('building the tree for cost profile {n} from {f}'.format(n=name, f=dictionary),
+              file=sys.stderr)
+        words = shufflewords(readdictionary(dictionary))
+        # on stderr, as the lookups that set this off may print on stdout
+        built = buildwords(words, distances, jobs or os.cpu_count(), log=sys.stderr)
+        os.makedirs(os.path.dirname(treelocation), exist_ok=True)
+        savetree(built, treelocation, distances.digest)
+        print('{n} words written to {f} in {t:.1f} seconds'.format(
+            n=len(words), f=treelocation, t=time.time()-starttime), file=sys.stderr)
+    return treelocation, distlocation
+
+def readindex(treelocation=None, distlocation='dist.json'):
+    '''The distance matrix, tree file and tree for lookups.  A tree built
+    with other distances is refused.'''
+    matrix = readdistances(distlocation)
+    treelocation = treelocation or defaulttree()
+    digest = loaddigest(treelocation)
+    if digest is not None and digest != distancesdigest(matrix):
+        raise ValueError('{t} was built with other distances than {d}; build it again, '
+                         'or use a cost profile'.format(t=treelocation, d=distlocation))
+    return matrix, treelocation, loadtree(treelocation)
+
+def addlookupoptions(parser):
+    parser.add_argument('--tree', help='lookup tree (default tree.idx if present, else tree.json)')
+    parser.add_argument('--distances', default='dist.json')
+    parser.add_argument('--profile', help='use the cost profile profiles/PROFILE.json and '
+                                          'its tree (built on first use) instead')
+    parser.add_argument('--engine', default='tree',
+        choices=['tree', 'scan', 'pivots', 'trie', 'reversetrie', 'ngrams', 'graph'],
+        help='walk the lookup tree, score every word at once with NumPy, rule '
+             'words out by their distances to pivot words (also NumPy), walk '
+             'a trie of pronunciations from the front or from the back, only '
+             'score the words sharing the most runs of sounds, or walk a graph '
+             'of neighbouring words (the last two approximate, with NumPy)')
+    parser.add_argument('--pivots', type=int, default=32, metavar='COUNT',
+        help='how many pivot words the pivots engine uses')
+    parser.add_argument('--candidates', type=int, default=2000,
+        help='how many words the ngrams engine scores')
+    parser.add_argument('--gram', type=int, default=2,
+        help='how many sounds in a row (1 to {}) the ngrams engine matches'.format(maxgram))
+    parser.add_argument('--collapse-stress', action='store_true',
+        help='let the ngrams engine match stressed vowels with unstressed ones')
+    parser.add_argument('--beam', type=int, default=32,
+        help='how many words the graph engine keeps while searching')
+    parser.add_argument('--shard-jobs', type=int, default=1, metavar='JOBS',
+        help='with a sharded index (--tree shards.json), search its shards on '
+             'this many processes at once')
+    parser.add_argument('--bulk', action='store_true',
+        help='in the tree walk, score the children of a node together with NumPy')
+    parser.add_argument('--stats', action='store_true',
+        help='report the work done by each lookup')
+    parser.add_argument('--cache', type=int, default=0, metavar='ENTRIES',
+        help='keep the results of this many recent lookups')
+    parser.add_argument('--cache-memory', type=float, metavar='MB',
+        help='and no more than about this much memory for them')
+
+def lookupsettings(options):
+    return {'engine': options.engine, 'pivots': options.pivots,
+            'candidates': options.candidates, 'gram': options.gram,
+            'collapse': options.collapse_stress, 'beam': options.beam,
+            'shardjobs': options.shard_jobs,
+            'bulk': options.bulk, 'stats': options.stats,
+            'cache': options.cache, 'cachememory': options.cache_memory}
+
+def checksettings(settings):
+    if (settings['engine'] in ('scan', 'pivots', 'ngrams', 'graph') or settings['bulk']) and numpy is None:
+        raise ValueError('--engine scan, pivots, ngrams and graph, and --bulk need NumPy')
+    if not 1 <= settings['gram'] <= maxgram:
+        raise ValueError('--gram must be from 1 to {}'.format(maxgram))
+
+def setlookupoptions(parser, options):
+    settings = lookupsettings(options)
+    try:
+        checksettings(settings)
+        if options.profile is not None:
+            if options.tree is not None:
+                raise ValueError('give --tree or --profile, not both')
+            options.tree, options.distances = profileindex(options.profile)
+    except (ValueError, OSError) as error:
+        # OSError: no dictionary to build the profile's tree from
+        parser.error(str(error))
+    return settings
+
+def defaultsettings():
+    import argparse
+    parser = argparse.ArgumentParser()
+    addlookupoptions(parser)
+    return lookupsettings(parser.parse_args([]))
+
+def readdictionary(filelocation):
+    '''Reads a cmudict-format file into a list of Words, one per
+    pronunciation.  Alternate pronunciations `word(2)' keep the plain
+    spelling, comments after `#' are dropped and duplicate entries
+    (after stress and CH/JH normalisation) are kept only once.'''
+    words = []
+    seen = set()
+    f = open(filelocation, encoding='utf-8', errors='replace')
+    for line in f:
+        fields = line.split('#', 1)[0].split()
+        if not fields:
+            continue
+        spell = fields[0]
+        if spell.endswith(')') and '(' in spell:
+            spell = spell[:spell.rindex('(')]
+        word = Word(spell, fields[1:])
+        key = (word.spell, tuple(word.pronna))
+        if key not in seen:
+            seen.add(key)
+            words.append(word)
+    f.close()
+    return words
+
+def buildworkerinit(prons, matrix):
+    global BUILDPRONS
+    global BUILDDISTANCES
+    BUILDPRONS = prons
+    BUILDDISTANCES = Distances(matrix)
+
+def buildworker(pairs):
+    return [BUILDDISTANCES.distance(BUILDPRONS[i], BUILDPRONS[j]) for i, j in pairs]
+
+def pairdistances(words, distances, pool, pairs, chunksize):
+    '''Yields the distance of words[i] from words[j] for each (i, j) in
+    pairs, in order, computed in chunks on the pool (or inline without
+    one).'''
+    chunks = [pairs[k:k+chunksize] for k in range(0, len(pairs), chunksize)]
+    if pool is None:
+        results = ([distances.distance(words[i].pronna, words[j].pronna) for i, j in chunk]
+                   for chunk in chunks)
+    else:
+        results = pool.imap(buildworker, chunks)
+    for result in results:
+        for dist in result:
+            yield dist
+
+def shufflewords(words, seed=0):
+    '''Returns words in a seeded shuffle that does not depend on the
+    order they were read in.'''
+    order = sorted(words, key=lambda word: (word.spell, word.pronna))
+    random.Random(seed).shuffle(order)
+    return order
+
+def chooseroot(words, distances, pool=None, candidates=32, sample=1000, chunksize=2000):
+    '''Returns the index of the word among the first `candidates' whose
+    distances to a sample of the other words spread most evenly over the
+    ranks, i.e. whose largest rank has the fewest words.'''
+    candidates = min(candidates, len(words))
+    samplewords = range(candidates, min(candidates+sample, len(words)))
+    pairs = [(c, s) for c in range(candidates) for s in samplewords]
+    dists = pairdistances(words, distances, pool, pairs, chunksize)
+    best = (len(samplewords)+1, 0)
+    for c in range(candidates):
+        counts = dict()
+        for s in samplewords:
+            dist = next(dists)
+            counts[dist] = counts.get(dist, 0) + 1
+        largest = max(counts.values(), default=0)
+        if largest < best[0]:
+            best = (largest, c)
+    return best[1]
+
+def buildtree(words, order, distances, pool=None, chunksize=2000, progress=5.0, log=None):
+    '''Builds the tree that inserting words[order[0]], words[order[1]],
+    ... with Tree.addword would give.  The tree is grown one level at a
+    time: every word still to be placed is compared with the root of its
+    current subtree, and these comparisons are independent, so each level
+    runs on the pool.  Progress is printed to log (by default stdout).'''
+    tree = Tree(words[order[0]])
+    pending = [(tree, order[0], order[1:])]
+    starttime = time.time()
+    level = 0
+    while pending:
+        level += 1
+        pairs = [(pivot, i) for node, pivot, members in pending for i in members]
+        dists = pairdistances(words, distances, pool, pairs, chunksize)
+        lastreport = time.time()
+        done = 0
+        nextpending = []
+        for node, pivot, members in pending:
+            buckets = dict()
+            for i in members:
+                dist = next(dists)
+                if dist in buckets:
+                    buckets[dist][2].append(i)
+                else:
+                    buckets[dist] = (Tree(words[i]), i, [])
+            node.setchildren((dist, bucket[0]) for dist, bucket in buckets.items())
+            nextpending.extend(bucket for bucket in buckets.values() if bucket[2])
+            done += len(members)
+            if progress and time.time() - lastreport >= progress:
+                lastreport = time.time()
+                print('  level {l}: {done}/{total} comparisons, {t:.1f} seconds'.format(
+                    l=level, done=done, total=len(pairs), t=lastreport-starttime), file=log)
+        pending = nextpending
+        if progress:
+            print('level {l}: {n} comparisons, {p} subtrees left, {t:.1f} seconds'.format(
+                l=level, n=len(pairs), p=len(pending), t=time.time()-starttime), file=log)
+    return tree
+
+def buildwords(words, distances, jobs, chunksize=2000, log=None):
+    '''The tree of words (in their insertion order but for the root)
+    under distances, built on jobs worker processes, with progress
+    printed to log.'''
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, initializer=buildworkerinit,
+            initargs=([word.pronna for word in words], distances.matrix))
+    try:
+        root = chooseroot(words, distances, pool, chunksize=chunksize)
+        print('root: {w}'.format(w=words[root]), file=log)
+        order = [root] + [i for i in range(len(words)) if i != root]
+        return buildtree(words, order, distances, pool, chunksize, log=log)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+def lengthbands(words, count):
+    '''Bands of pronunciation lengths, as (lowest, highest or None), that
+    split words into count shards as evenly as whole lengths allow.'''
+    lengths = collections.Counter(len(word.pronna) for word in words)
+    highs = []
+    held = 0
+    for length in sorted(lengths):
+        held += lengths[length]
+        if len(highs) < count - 1 and held >= len(words) * (len(highs) + 1) / count:
+            highs.append(length)
+    return bandsbelow(highs)
+
+def bandsbelow(highs):
+    '''The bands of lengths up to each of highs in turn, and above.'''
+    return list(zip([1] + [high + 1 for high in highs], highs + [None]))
+
+def shardname(band):
+    low, high = band
+    return 'len{:02d}-{}.idx'.format(low, 'up' if high is None else '{:02d}'.format(high))
+
+def shard(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog='echoes.py shard',
+        description='Builds a lookup tree per band of pronunciation lengths, and a '
+                    'manifest to look them up through with --tree DIRECTORY/shards.json.')
+    parser.add_argument('dictionary', nargs='?', default=dictionary)
+    parser.add_argument('-o', '--output', default='shards', help='directory for the shards')
+    parser.add_argument('-d', '--distances', default='dist.json')
+    parser.add_argument('-n', '--shards', type=int, default=4,
+        help='how many shards, of about as many words each')
+    parser.add_argument('--bands', help='the highest length of each band but the '
+                                        'last, like 5,6,8 (instead of --shards)')
+    parser.add_argument('--only', type=int, metavar='SHARD',
+        help='rebuild just this shard (counting from 0) of an existing manifest')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+        help='worker processes (1 to build in this process)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunksize', type=int, default=2000)
+    options = parser.parse_args(args)
+    starttime = time.time()
+    establishencoding()
+    distances = Distances(readdistances(options.distances))
+    words = shufflewords(readdictionary(options.dictionary), options.seed)
+    print('{n} pronunciations read from {f}'.format(n=len(words), f=options.dictionary))
+    if not words:
+        return
+    location = os.path.join(options.output, 'shards.json')
+    if options.only is not None:
+        f = open(location)
+        manifest = json.load(f)
+        f.close()
+        bands = [tuple(shard['lengths']) for shard in manifest['shards']]
+        if not 0 <= options.only < len(bands):
+            parser.error('{} has shards 0 to {}'.format(location, len(bands) - 1))
+    elif options.bands:
+        bands = bandsbelow([int(high) for high in options.bands.split(',')])
+    else:
+        bands = lengthbands(words, options.shards)
+    os.makedirs(options.output, exist_ok=True)
+    shards = []
+    for i, (low, high) in enumerate(bands):
+        members = [word for word in words
+                   if low <= len(word.pronna) and (high is None or len(word.pronna) <= high)]
+        shards.append({'file': shardname((low, high)), 'lengths': [low, high], 'words': len(members)})
+        if options.only is not None and i != options.only:
+            continue
+        print('shard {i}: lengths {b}, {n} words'.format(
+            i=i, b='{}-{}'.format(low, '' if high is None else high), n=len(members)))
+        if members:
+            savetree(buildwords(members, distances, options.jobs, options.chunksize),
+                     os.path.join(options.output, shards[-1]['file']), distances.digest)
+    shards = [shard for shard in shards if shard['words']]
+    f = open(location + '.tmp', 'w')
+    json.dump({'shards': shards}, f, indent=1)
+    f.close()
+    os.replace(location + '.tmp', location)
+    savedigest(location, distances.digest)
+    print('{n} shards listed in {f} in {t:.1f} seconds'.format(
+        n=len(shards), f=location, t=time.time()-starttime))
+
+def build(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog='echoes.py build',
+        description='Builds the lookup tree from a cmudict-format dictionary.')
+    parser.add_argument('dictionary', nargs='?', default=dictionary)
+    parser.add_argument('-o', '--output', default='tree.json')
+    parser.add_argument('-d', '--distances', default='dist.json')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+        help='worker processes (1 to build in this process)')
+    parser.add_argument('--seed', type=int, default=0,
+        help='seed for the insertion order')
+    parser.add_argument('--chunksize', type=int, default=2000)
+    options = parser.parse_args(args)
+    starttime = time.time()
+    establishencoding()
+    distances = Distances(readdistances(options.distances))
+    words = shufflewords(readdictionary(options.dictionary), options.seed)
+    print('{n} pronunciations read from {f}'.format(n=len(words), f=options.dictionary))
+    if not words:
+        return
+    tree = buildwords(words, distances, options.jobs, options.chunksize)
+    savetree(tree, options.output, distances.digest)
+    print('{n} words written to {f} in {t:.1f} seconds'.format(
+        n=len(words), f=options.output, t=time.time()-starttime))
+
+def deepsize(thing):
+    '''The bytes taken by thing and every object it leads to, each
+    counted once (classes excepted).'''
+    seen = set()
+    total = 0
+    stack = [thing]
+    while stack:
+        thing = stack.pop()
+        if id(thing) in seen or isinstance(thing, type):
+            continue
+        seen.add(id(thing))
+        total += sys.getsizeof(thing)
+        stack.extend(gc.get_referents(thing))
+    return total
+
+def treestats(tree):
+    '''The shape of a tree: words per depth, nodes per number of
+    children, children per rank, subtrees per size (by powers of two)
+    and the size of the root's subtree at each rank.'''
+    if isinstance(tree, TreeIndex):
+        children = tree.children
+        root = 0
+    else:
+        children = Tree.items
+        root = tree
+    parents = []
+    ranks = []
+    depths = collections.Counter()
+    fanout = collections.Counter()
+    edges = collections.Counter()
+    stack = [(root, -1, 0, None)]
+    while stack:
+        node, parent, depth, rank = stack.pop()
+        position = len(parents)
+        parents.append(parent)
+        ranks.append(rank)
+        depths[depth] += 1
+        count = 0
+        for childrank, child in children(node):
+            count += 1
+            edges[childrank] += 1
+            stack.append((child, position, depth+1, childrank))
+        fanout[count] += 1
+    # children always come after their parent
+    sizes = [1] * len(parents)
+    for position in range(len(parents)-1, 0, -1):
+        sizes[parents[position]] += sizes[position]
+    subtrees = collections.Counter(2 ** (size.bit_length() - 1) for size in sizes)
+    rootsubtrees = dict((ranks[position], sizes[position])
+                        for position in range(1, len(parents)) if parents[position] == 0)
+    return {'words': len(parents),
+            'depth': {'max': max(depths), 'mean': sum(d * c for d, c in depths.items()) / len(parents)},
+            'words per depth': dict(sorted(depths.items())),
+            'nodes per fan-out': dict(sorted(fanout.items())),
+            'children per rank': dict(sorted(edges.items())),
+            'subtrees per size': dict(sorted(subtrees.items())),
+            'root subtree sizes': dict(sorted(rootsubtrees.items())),
+            # a TreeIndex is the file, mapped
+            'bytes': len(tree.buffer) if isinstance(tree, TreeIndex) else deepsize(tree)}
+
+def stats(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog='echoes.py stats',
+        description='Describes the shape of the lookup tree.')
+    parser.add_argument('--tree', help='lookup tree (default tree.idx if present, else tree.json)')
+    parser.add_argument('--distances', default='dist.json')
+    parser.add_argument('--json', action='store_true', help='print the figures as JSON')
+    options = parser.parse_args(args)
+    echoes = Echoes(options.tree, options.distances)
+    echoes.load()
+    tree = echoes.tree
+    if isinstance(tree, ShardedIndex):
+        for i, shardtree in enumerate(tree.trees):
+            figures = treestats(shardtree)
+            low, high = tree.bands[i]
+            print('shard {i}: lengths {l}-{h}, {w} words in {f}, depth up to {d}, {b:.1f} MB'.format(
+                i=i, l=low, h='' if high is None else high, w=figures['words'], f=tree.files[i],
+                d=figures['depth']['max'], b=figures['bytes'] / 2**20))
+        return
+    figures = treestats(tree)
+    figures['added'] = 0 if echoes.overlay is None else sum(1 for word in treewords(echoes.overlay))
+    figures['removed'] = len(echoes.tombstones)
+    if options.json:
+        print(json.dumps(figures, indent=1))
+        return
+    print('{w} words in {f}, {a} added and {r} removed since'.format(
+        w=figures['words'], f=echoes.treefile, a=figures['added'], r=figures['removed']))
+    print('depth up to {max}, {mean:.2f} on average'.format(**figures['depth']))
+    print('{b:.1f} MB in memory, {w:.0f} bytes per word'.format(
+        b=figures['bytes'] / 2**20, w=figures['bytes'] / figures['words']))
+    for title, heading, column in (('words per depth', 'depth', 'words'),
+                                   ('nodes per fan-out', 'children', 'nodes'),
+                                   ('children per rank', 'rank', 'children'),
+                                   ('subtrees per size', 'size from', 'subtrees'),
+                                   ('root subtree sizes', 'root rank', 'words')):
+        print()
+        print('  {:>10} {}'.format(heading, column))
+        for key, value in figures[title].items():
+            print('  {:>10} {}'.format(key, value))
+
+def convert(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog='echoes.py convert',
+        description='Converts a lookup tree between the JSON and binary index formats.')
+    parser.add_argument('input', nargs='?', default='tree.json')
+    parser.add_argument('output', nargs='?', default='tree.idx')
+    parser.add_argument('-d', '--distances', default='dist.json',
+        help='the distances the tree was built with, if it does not record them')
+    options = parser.parse_args(args)
+    starttime = time.time()
+    establishencoding()
+    loaded = loadtree(options.input)
+    if isinstance(loaded, TreeIndex):
+        loaded = indextotree(loaded)
+    digest = loaddigest(options.input)
+    if digest is None:
+        # nothing to go by, so the distances are taken on trust
+        digest = distancesdigest(readdistances(options.distances))
+    savetree(loaded, options.output, digest)
+    print('{i} converted to {o} in {t:.1f} seconds'.format(
+        i=options.input, o=options.output, t=time.time()-starttime))
+
+def wordkey(word):
+    return (word.spell, tuple(word.pronna))
+
+def treestamp(filelocation):
+    f = open(filelocation, 'rb')
+    digest = hashlib.sha1()
+    for block in iter(lambda: f.read(2**20), b''):
+        digest.update(block)
+    f.close()
+    return {'size': os.path.getsize(filelocation), 'sha1': digest.hexdigest()}
+
+def journallocation(echoes):
+    return echoes.treefile + '.journal'
+
+def applychange(echoes, change):
+    word = Word(change['word'], change['pron'].split())
+    key = wordkey(word)
+    if change['op'] == 'remove':
+        echoes.tombstones.add(key)
+    elif key in echoes.tombstones:
+        echoes.tombstones.discard(key)
+    elif echoes.overlay is None:
+        echoes.overlay = Tree(word)
+    else:
+        echoes.overlay.addword(word, echoes.distances)
+
+def replayjournal(echoes):
+    '''Applies the changes journaled for the tree file of echoes.  The
+    journal starts with the size and SHA-1 digest of the tree file
+    it belongs to; a journal left over from another tree file is ignored
+    (compact writes the new journal beside it before moving it in).'''
+    echoes.overlay = None
+    echoes.tombstones = set()
+    echoes.journalentries = 0
+    echoes.generation += 1
+    stamp = None
+    for location in (journallocation(echoes), journallocation(echoes) + '.tmp'):
+        if not os.path.exists(location):
+            continue
+        # hashing the tree file is only worth it with a journal to match
+        if stamp is None:
+            stamp = treestamp(echoes.treefile)
+        f = open(location, encoding='utf-8')
+        changes = [json.loads(line) for line in f if line.strip()]
+        f.close()
+        if not changes or changes[0].get('tree') != stamp:
+            print('ignoring {}: it belongs to another version of {}'.format(location, echoes.treefile),
+                  file=sys.stderr)
+            continue
+        for change in changes[1:]:
+            applychange(echoes, change)
+        echoes.journalentries = len(changes) - 1
+        return
+
+def haswordkey(echoes, key):
+    '''Whether the word with this key is in the tree and not removed.'''
+    pron = list(key[1])
+    if isinstance(echoes.tree, ShardedIndex):
+        found = shardgenie(echoes, pron, None, 0)
+    else:
+        found = nearestgenie(echoes.tree, echoes.distances, pron, None, False, 0)
+    if echoes.overlay is not None:
+        found = itertools.chain(found, nearestgenie(echoes.overlay, echoes.distances, pron, None,
+                                                    False, 0))
+    return any(wordkey(word) == key for dist, word in found) and key not in echoes.tombstones
+
+def journal(echoes, changes):
+    echoes.generation += 1
+    location = journallocation(echoes)
+    new = not os.path.exists(location)
+    f = open(location, 'a', encoding='utf-8')
+    if new:
+        f.write(json.dumps({'tree': treestamp(echoes.treefile)}) + '\n')
+    for change in changes:
+        f.write(json.dumps(change) + '\n')
+    f.close()
+    echoes.journalentries += len(changes)
+
+def changejson(op, word):
+    return {'op': op, 'word': word.spell, 'pron': ' '.join(ntops(word.pronna))}
+
+def addwords(echoes, words):
+    '''Adds words to the tree of echoes and journals them.  Returns the
+    words that were not there already.'''
+    changes = []
+    for word in words:
+        key = wordkey(word)
+        if key in echoes.tombstones or not haswordkey(echoes, key):
+            changes.append(changejson('add', word))
+            applychange(echoes, changes[-1])
+    journal(echoes, changes)
+    return [Word(change['word'], change['pron'].split()) for change in changes]
+
+def removewords(echoes, words):
+    '''Removes words from the tree of echoes and journals it.  They stay
+    in the tree to guide the search but are no longer matched.  Returns
+    the words that were there.'''
+    changes = []
+    for word in words:
+        if haswordkey(echoes, wordkey(word)):
+            changes.append(changejson('remove', word))
+            applychange(echoes, changes[-1])
+    journal(echoes, changes)
+    return [Word(change['word'], change['pron'].split()) for change in changes]
+
+def compact(echoes):
+    '''Folds the journal into the tree file and reloads it.  A removed
+    word's node is cut out and the words below it are added again; only
+    a removed root stays, as a journaled removal.'''
+    tree = echoes.tree
+    tombstones = echoes.tombstones
+    treefile = echoes.treefile
+    base = indextotree(tree) if isinstance(tree, TreeIndex) else tree
+    orphans = []
+    stack = [base]
+    while stack:
+        node = stack.pop()
+        kept = []
+        for rank, child in node.items():
+            if wordkey(child.root) in tombstones:
+                orphans.extend(treewords(child))
+            else:
+                kept.append((rank, child))
+                stack.append(child)
+        node.setchildren(kept)
+    if echoes.overlay is not None:
+        orphans.extend(treewords(echoes.overlay))
+    for word in orphans:
+        if wordkey(word) not in tombstones:
+            base.addword(word, echoes.distances)
+    remaining = [changejson('remove', base.root)] if wordkey(base.root) in tombstones else []
+    # write the tree and its new journal beside the old ones, then move
+    # them in: until the journal is moved the old one no longer matches
+    # the tree and is skipped in favour of the new one
+    name, extension = os.path.splitext(treefile)
+    newfile = name + '.new' + extension
+    savetree(base, newfile, echoes.distances.digest)
+    f = open(journallocation(echoes) + '.tmp', 'w', encoding='utf-8')
+    f.write(json.dumps({'tree': treestamp(newfile)}) + '\n')
+    for change in remaining:
+        f.write(json.dumps(change) + '\n')
+    f.close()
+    os.replace(newfile, treefile)
+    os.replace(newfile + '.distances', treefile + '.distances')
+    os.replace(journallocation(echoes) + '.tmp', journallocation(echoes))
+    echoes.tree = loadtree(treefile)
+    replayjournal(echoes)
+
+def update(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog='echoes.py update',
+        description='Adds words to or removes words from the lookup tree without '
+                    'rebuilding it.  Changes are journaled beside the tree and '
+                    'folded into it by compact.')
+    parser.add_argument('action', choices=['add', 'remove', 'compact'])
+    parser.add_argument('entry', nargs='*', help='a word and its pronunciation, e.g. '
+                        'echoes EH1 K OW Z')
+    parser.add_argument('-f', '--file', help='cmudict-format file of words')
+    parser.add_argument('--compact-after', type=int, default=10000, metavar='CHANGES',
+        help='compact once the journal holds this many changes')
+    parser.add_argument('--tree', help='lookup tree (default tree.idx if present, else tree.json)')
+    parser.add_argument('--distances', default='dist.json')
+    options = parser.parse_args(args)
+    starttime = time.time()
+    echoes = Echoes(options.tree, options.distances)
+    echoes.load()
+    if options.action == 'compact' and isinstance(echoes.tree, ShardedIndex):
+        parser.error('the words of a sharded index are folded in by building its shards again')
+    words = []
+    if options.file:
+        words.extend(readdictionary(options.file))
+    if options.entry:
+        if len(options.entry) < 2:
+            parser.error('give a word and its pronunciation')
+        words.append(Word(options.entry[0], options.entry[1:]))
+    if options.action == 'add':
+        changed = addwords(echoes, words)
+    elif options.action == 'remove':
+        changed = removewords(echoes, words)
+    if options.action != 'compact':
+        print('{n} of {m} words {a}ed in {t:.3f} seconds'.format(
+            n=len(changed), m=len(words), a=options.action.rstrip('e'), t=time.time()-starttime))
+    if options.action == 'compact' or (echoes.journalentries >= options.compact_after and
+                                       not isinstance(echoes.tree, ShardedIndex)):
+        starttime = time.time()
+        compact(echoes)
+        print('{f} compacted in {t:.1f} seconds'.format(f=echoes.treefile, t=time.time()-starttime))
+
+def findmatches(echoes, mypron, n, maxdistance=None):
+    '''The n best matches, as (distance, spelling, pronunciation).'''
+    return findmeasuredmatches(echoes, mypron, n, maxdistance)[0]
+
+def findmeasuredmatches(echoes, mypron, n, maxdistance=None):
+    '''findmatches, and the QueryStats of finding them as a dict when
+    --stats is on (None otherwise).'''
+    if not mypron:
+        return [], None
+    matches, stats = measuredquery(echoes, mypron, n, maxdistance, echoes.showstats)
+    return ([(dist, word.spell, ' '.join(ntops(word.pronna))) for dist, word in matches],
+            None if stats is None else stats.asdict())
+
+def matchesjson(matches):
+    return [{'distance': dist, 'word': spell, 'pron': pron} for dist, spell, pron in matches]
+
+Match = collections.namedtuple('Match', ['distance', 'word', 'pron'])
+
+class Echoes:
+    ''' A lookup engine with its own distances, tree and settings, for
+    using Echoes as a library:
+
+        echoes = Echoes('tree.idx', engine='pivots')
+        echoes.lookup('HH AH L OW1', 5)
+        Echoes(profile='nostress').lookup('HH AH L OW1', 5)
+
+    Nothing is read until the first lookup, or until load is called;
+    with background set, a thread starts loading at once.  The engine
+    holds all of its state, and the module's lookup functions are given
+    the engine to work on, so engines go on side by side; the methods
+    hold the engine's lock while they look up, so one engine can be
+    shared between threads.  The settings are those of lookupsettings; a
+    profile names a cost profile to use instead of the tree and
+    distances.  The searches of paged lookups are kept in the engine, or
+    with cursors unset saved whole in their continuations (signed with
+    cursorkey, if it is set).
+    '''
+    def __init__(self, tree=None, distances='dist.json', background=False, profile=None,
+                 cursors=True, **settings):
+        unknown = set(settings) - set(defaultsettings())
+        if unknown:
+            raise TypeError('unknown settings: ' + ', '.join(sorted(unknown)))
+        self.treelocation = tree
+        self.distlocation = distances
+        self.profile = profile
+        self.settings = settings = dict(defaultsettings(), **settings)
+        checksettings(settings)
+        # one of the --engine choices (see approximateengines)
+        self.engine = settings['engine']
+        self.pivotcount = settings['pivots']
+        self.candidates = settings['candidates']
+        self.gramsize = settings['gram']
+        self.collapsestress = settings['collapse']
+        self.beam = settings['beam']
+        # processes searching the shards of a ShardedIndex at the same time
+        self.shardjobs = settings['shardjobs']
+        # score many children of a node at once with NumPy in the tree walk
+        self.bulk = settings['bulk']
+        # report the work done by each lookup
+        self.showstats = settings['stats']
+        self.cache = None
+        if settings['cache'] > 0:
+            maxbytes = settings['cachememory']
+            self.cache = LookupCache(settings['cache'],
+                                     None if maxbytes is None else int(maxbytes * 2**20))
+        # the Distances, tree and tree file, once loaded
+        self.distances = None
+        self.tree = None
+        self.treefile = None
+        # words added since the tree was built, and words removed from it
+        self.overlay = None
+        self.tombstones = set()
+        # counts changes to the words, for the cache
+        self.generation = 0
+        self.journalentries = 0
+        # the tables of the engines, built on first use
+        self.pivots = None
+        self.tries = dict()
+        self.ngrams = None
+        self.graph = None
+        self.buckets = None
+        self.nodenumbers = None
+        self.shardpool = None
+        # a CursorStore keeping the searches of paged lookups
+        self.cursors = CursorStore() if cursors else None
+        # the key continuations are signed with, so that only those made
+        # with it are taken up (serve makes one for its workers)
+        self.cursorkey = None
+        # functions called with the QueryStats of each query from measuredquery
+        self.queryhooks = []
+        self.lock = threading.RLock()
+        self.loading = threading.Lock()
+        self.loaded = False
+        self.error = None
+        self.loader = None
+        if background:
+            self.loader = threading.Thread(target=self.preload, daemon=True)
+            self.loader.start()
+
+    def load(self):
+        '''Reads the distances and tree, with the changes in the tree's
+        journal applied, unless already done; raises again whatever
+        stopped an earlier load.  A tree built with other distances is
+        refused.'''
+        self.preload()
+        if self.error is not None:
+            raise self.error
+
+    def preload(self):
+        with self.loading:
+            if not self.loaded and self.error is None:
+                try:
+                    treelocation, distlocation = self.treelocation, self.distlocation
+                    if self.profile is not None:
+                        treelocation, distlocation = profileindex(self.profile)
+                    matrix, self.treefile, self.tree = readindex(treelocation, distlocation)
+                    self.distances = Distances(matrix)
+                    replayjournal(self)
+                    self.loaded = True
+                except LookupTimeout:
+                    # the lookup waiting on the load ran out of time, not the load
+                    raise
+                except Exception as error:
+                    self.error = error
+
+    @contextlib.contextmanager
+    def active(self):
+        '''A context holding the engine's lock, loading it first if
+        needed.'''
+        self.load()
+        with self.lock:
+            yield self
+
+    def parse(self, pron):
+        if isinstance(pron, str):
+            pron = pron.split()
+        return ptons(pron)
+
+    def lookup(self, pron, n=10, maxdistance=None):
+        '''The n best matches for pron (a string of sounds like
+        'HH AH L OW1', or a list of them), as Matches.'''
+        with self.active():
+            return [Match(*match) for match in findmatches(self, self.parse(pron), n, maxdistance)]
+
+    def page(self, pron, n=10, maxdistance=None):
+        '''The first n Matches for pron, and a continuation to give more
+        for the next ones (None when there are no more).'''
+        with self.active():
+            mypron = self.parse(pron)
+            if not mypron:
+                return [], None
+            return self.matchpage(*lookuppage(self, mypron, n, maxdistance))
+
+    def more(self, continuation, n=10):
+        '''The next n Matches of a lookup begun with page, and the next
+        continuation.  Raises ContinuationError for a continuation that
+        has expired or was made before the words or distances changed.'''
+        with self.active():
+            return self.matchpage(*lookuppage(self, None, n, None, continuation))
+
+    @staticmethod
+    def matchpage(matches, continuation):
+        return ([Match(dist, word.spell, ' '.join(ntops(word.pronna))) for dist, word in matches],
+                continuation)
+
+    def matches(self, pron, maxdistance=None):
+        '''Generates every match for pron in order, or those within
+        maxdistance, as Matches; the engine is only held while finding
+        the next one.'''
+        with self.active():
+            mypron = self.parse(pron)
+            if not mypron:
+                return
+            genie = lookupgenie(self, mypron, None, maxdistance)
+        while True:
+            with self.lock:
+                found = next(genie, None)
+                if found is None:
+                    return
+                dist, word = found
+                match = Match(dist, word.spell, ' '.join(ntops(word.pronna)))
+            yield match
+
+# the engines of a process looking up for batch or serve, by cost profile
+# (None for that of --tree and --distances)
+workerengines = dict()
+
+def batchworkerinit(treelocation, distlocation, settings, worker=True):
+    # a forked worker already has the parent's engine
+    if None not in workerengines:
+        if worker:
+            # a worker searches the shards itself, rather than starting a pool of its own
+            settings = dict(settings, shardjobs=1)
+        workerengines[None] = Echoes(treelocation, distlocation, cursors=False, **settings)
+    workerengines[None].load()
+
+def batchworker(lines, n):
+    echoes = workerengines[None]
+    myprons = [ptons(line.split()) for line in lines]
+    if echoes.showstats or echoes.queryhooks or echoes.cache is not None:
+        return [findmeasuredmatches(echoes, mypron, n) for mypron in myprons]
+    # the same matches as findmatches, the chunk's lines searched together
+    found = iter(batchlookup(echoes, [mypron for mypron in myprons if mypron], n))
+    return [([(dist, word.spell, ' '.join(ntops(word.pronna))) for dist, word in next(found)]
+             if mypron else [], None) for mypron in myprons]
+
+def writebatch(out, lines, results, form, totals=None):
+    for line, (matches, stats) in zip(lines, results):
+        if stats is not None and totals is not None:
+            for name in ('queries', 'distances', 'cells', 'visited', 'pruned'):
+                totals[name] = totals.get(name, 0) + stats[name]
+        if form == 'jsonl':
+            record = {'input': line, 'matches': matchesjson(matches)}
+            if stats is not None:
+                record['stats'] = stats
+            out.write(json.dumps(record) + '\n')
+        else:
+            for rank, (dist, spell, pron) in enumerate(matches):
+                out.write('{}\t{}\t{}\t{}\t{}\n'.format(line, rank+1, dist, spell, pron))
+
+def batch(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog='echoes.py batch',
+        description='Looks up every line of a file, one pronunciation per line.')
+    parser.add_argument('input', nargs='?', default='-', help='input file (default stdin)')
+    parser.add_argument('-o', '--output', default='-', help='output file (default stdout)')
+    parser.add_argument('-n', type=int, default=10, help='matches per pronunciation')
+    parser.add_argument('-f', '--format', choices=['jsonl', 'tsv'], default='jsonl',
+        help='one JSON object per line, or one tab-separated line per match '
+             '(input, rank, distance, word, pronunciation)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+        help='worker processes (1 to look up in this process)')
+    parser.add_argument('--chunksize', type=int, default=100,
+        help='lines handed to a worker at a time, and searched together')
+    addlookupoptions(parser)
+    options = parser.parse_args(args)
+    settings = setlookupoptions(parser, options)
+    starttime = time.time()
+    source = sys.stdin if options.input == '-' else open(options.input, encoding='utf-8')
+    out = sys.stdout if options.output == '-' else open(options.output, 'w', encoding='utf-8')
+    initargs = (options.tree, options.distances, settings)
+    pool = None
+    if options.jobs > 1:
+        pool = multiprocessing.Pool(options.jobs, initializer=batchworkerinit, initargs=initargs)
+    else:
+        batchworkerinit(*initargs, worker=False)
+    # at most two chunks per worker are read ahead, whatever the input size
+    pending = collections.deque()
+    totals = dict()
+    done = 0
+    lastreport = time.time()
+    try:
+        while True:
+            chunk = [line.rstrip('\r\n') for line in itertools.islice(source, options.chunksize)]
+            if chunk:
+                if pool is None:
+                    pending.append((chunk, batchworker(chunk, options.n)))
+                else:
+                    pending.append((chunk, pool.apply_async(batchworker, (chunk, options.n))))
+            while pending and (not chunk or len(pending) >= 2 * options.jobs):
+                lines, results = pending.popleft()
+                if pool is not None:
+                    results = results.get()
+                writebatch(out, lines, results, options.format, totals)
+                done += len(lines)
+            if time.time() - lastreport >= 5.0:
+                lastreport = time.time()
+                print('{n} lines, {t:.1f} seconds'.format(n=done, t=lastreport-starttime),
+                      file=sys.stderr)
+            if not chunk:
+                break
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if out is not sys.stdout:
+            out.close()
+        if source is not sys.stdin:
+            source.close()
+    stoptime = time.time()
+    print('{n} lines in {t:.1f} seconds'.format(n=done, t=stoptime-starttime), file=sys.stderr)
+    if totals:
+        print('{queries} lookups: {distances} distances, {cells} cells, '
+              '{visited} nodes visited, {pruned} pruned'.format(**totals), file=sys.stderr)
+
+class LookupTimeout(Exception):
+    pass
+
+def timeouthandler(signum, frame):
+    raise LookupTimeout()
+
+def serveengines(treelocation, distlocation, settings, profilenames=()):
+    '''Adds the engines a server's workers look up with to
+    workerengines, that of the tree and one for each cost profile a
+    request may pick, unless they are there already.'''
+    # a worker searches the shards itself, rather than starting a pool of its own
+    settings = dict(settings, shardjobs=1)
+    if None not in workerengines:
+        workerengines[None] = Echoes(treelocation, distlocation, cursors=False, **settings)
+    for name in profilenames:
+        if name not in workerengines:
+            workerengines[name] = Echoes(profile=name, cursors=False, **settings)
+
+def serveworkerinit(treelocation, distlocation, settings, profilenames=(), key=None):
+    # a forked worker already has the parent's engines
+    serveengines(treelocation, distlocation, settings, profilenames)
+    for echoes in workerengines.values():
+        echoes.cursorkey = key
+        # as serve does, before the time limits of lookups (a forked
+        # worker has the tables already)
+        with echoes.active():
+            warmengine(echoes)
+    if hasattr(signal, 'setitimer'):
+        signal.signal(signal.SIGALRM, timeouthandler)
+
+def findpage(echoes, mypron, n, maxdistance=None, continuation=None):
+    '''lookuppage, with matches as (distance, spelling, pronunciation).'''
+    matches, continuation = lookuppage(echoes, mypron, n, maxdistance, continuation)
+    return ([(dist, word.spell, ' '.join(ntops(word.pronna))) for dist, word in matches],
+            continuation)
+
+def serveworker(mypron, n, maxdistance, timeout, profile=None, paged=False, continuation=None):
+    '''findmatches, or findpage if paged (with the engine of a cost
+    profile, if one is named), interrupted with LookupTimeout after
+    timeout seconds where the platform has interval timers.'''
+    find = findmatches
+    if paged:
+        find = lambda echoes, mypron, n, maxdistance: findpage(echoes, mypron, n, maxdistance,
+                                                               continuation)
+    with workerengines[profile].active() as echoes:
+        if not hasattr(signal, 'setitimer'):
+            return find(echoes, mypron, n, maxdistance)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            return find(echoes, mypron, n, maxdistance)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+class LookupServer:
+    ''' A minimal HTTP/1.1 server answering
+
+        GET /lookup?pron=HH+AH+L+OW1&n=10&max_distance=5&profile=nostress
+        GET /lookup?pron=HH+AH+L+OW1&n=10&more=1
+        GET /lookup?next=CONTINUATION&n=10
+        GET /health
+
+    with JSON, profile being one of the cost profiles served.  With more,
+    the answer has a continuation to ask for the next matches with.  A
+    continuation longer than inline characters is kept here, in cursors,
+    and a short token for it given instead; the workers sign the
+    continuations they make with cursorkey.  Lookups run on a pool of worker processes so that the
+    event loop only parses requests and writes responses.
+    '''
+    def __init__(self, executor, words, timeout, maxn=1000, profiles=(),
+                 cursors=None, inline=512, cursorkey=None):
+        self.executor = executor
+        self.profiles = profiles
+        self.cursorkey = cursorkey
+        self.cursors = CursorStore() if cursors is None else cursors
+        self.inline = inline
+        self.words = words
+        self.timeout = timeout
+        self.maxn = maxn
+        self.served = 0
+        self.starttime = time.time()
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                requestline = await reader.readline()
+                if not requestline:
+                    break
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                parts = requestline.decode('latin-1').split()
+                if len(parts) != 3:
+                    status, body = 400, {'error': 'bad request line'}
+                elif parts[0] != 'GET':
+                    status, body = 405, {'error': 'only GET is supported'}
+                else:
+                    status, body = await self.respond(parts[1])
+                keepalive = (parts[-1:] == ['HTTP/1.1']
+                             and headers.get('connection', '').lower() != 'close')
+                data = json.dumps(body).encode('utf-8')
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n'
+                             'Content-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                                 status, http.HTTPStatus(status).phrase, len(data),
+                                 'keep-alive' if keepalive else 'close').encode('latin-1'))
+                writer.write(data)
+                await writer.drain()
+                self.served += 1
+                if not keepalive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+    async def respond(self, target):
+        url = urllib.parse.urlsplit(target)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path == '/health':
+            return 200, {'status': 'ok', 'words': self.words, 'served': self.served,
+                         'uptime': time.time() - self.starttime,
+                         'workers': workermemory(), 'cursors': self.cursors.stats()}
+        if url.path != '/lookup':
+            return 404, {'error': 'not found'}
+        pron = query.get('pron', [''])[0]
+        try:
+            n = int(query.get('n', ['10'])[0])
+            maxdistance = query.get('max_distance', [None])[0]
+            maxdistance = None if maxdistance is None else int(maxdistance)
+        except ValueError:
+            return 400, {'error': 'n and max_distance must be integers'}
+        if not 1 <= n <= self.maxn:
+            return 400, {'error': 'n must be between 1 and {}'.format(self.maxn)}
+        profile = query.get('profile', [None])[0]
+        if profile is not None and profile not in self.profiles:
+            return 400, {'error': 'profile must be one of: {}'.format(', '.join(self.profiles))}
+        continuation = query.get('next', [None])[0]
+        paged = continuation is not None or query.get('more', ['0'])[0] not in ('', '0')
+        mypron = None
+        if continuation is None:
+            mypron = ptons(pron.split())
+            if not mypron:
+                return 400, {'error': 'pron is missing'}
+        elif continuation.startswith('s'):
+            continuation = self.cursors.take(continuation[1:])
+            if continuation is None:
+                return 410, {'error': 'the continuation has expired or was used already'}
+        if continuation is not None:
+            # the continuation goes on with the profile it was made with
+            try:
+                profile = cursorprofile(continuation, self.cursorkey)
+            except ContinuationError as error:
+                return 410, {'error': str(error)}
+            if profile is not None and profile not in self.profiles:
+                return 410, {'error': 'the continuation is of a profile not served here'}
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, serveworker, mypron, n, maxdistance,
+                                      self.timeout, profile, paged, continuation)
+        try:
+            # the worker gives up by itself; this only covers a lost worker
+            found = await asyncio.wait_for(future, self.timeout + 5)
+        except (LookupTimeout, asyncio.TimeoutError):
+            return 504, {'error': 'lookup took longer than {} seconds'.format(self.timeout)}
+        except ContinuationError as error:
+            return 410, {'error': str(error)}
+        except Exception as error:
+            # a profile's engine that would not load, a lost worker...
+            print('lookup {} failed: {!r}'.format(target, error), file=sys.stderr)
+            return 500, {'error': 'the lookup failed: {}'.format(error)}
+        if not paged:
+            return 200, {'pron': ' '.join(ntops(mypron)), 'matches': matchesjson(found)}
+        matches, continuation = found
+        if continuation is not None and len(continuation) > self.inline:
+            continuation = 's' + self.cursors.put(continuation, len(continuation))
+        body = {'matches': matchesjson(matches), 'next': continuation}
+        if mypron is not None:
+            body['pron'] = ' '.join(ntops(mypron))
+        return 200, body
+
+def uniquememory(pid):
+    '''The bytes of memory that only process pid uses (its private pages),
+    where /proc tells, else None.'''
+    try:
+        f = open('/proc/{}/smaps_rollup'.format(pid))
+    except OSError:
+        return None
+    total = 0
+    for line in f:
+        if line.startswith(('Private_Clean:', 'Private_Dirty:')):
+            total += int(line.split()[1]) * 1024
+    f.close()
+    return total
+
+def workermemory():
+    return [{'pid': child.pid, 'unique bytes': uniquememory(child.pid)}
+            for child in multiprocessing.active_children()]
+
+def warmengine(echoes):
+    '''Builds the tables the engine looks words up in, where it needs
+    any, so that no lookup has to.'''
+    if isinstance(echoes.tree, ShardedIndex):
+        return
+    engine = echoes.engine
+    if engine == 'graph':
+        neighbourgraph(echoes)
+    elif engine == 'pivots':
+        pivottable(echoes)
+    elif engine in ('trie', 'reversetrie'):
+        phonetrie(echoes)
+    elif engine == 'ngrams':
+        ngramindex(echoes)
+    elif engine == 'scan':
+        lengthbuckets(echoes)
+
+def prefork(echoes):
+    '''Readies the index of echoes to be shared by forked workers: a
+    tree read from JSON is flattened into shared memory, the engine's
+    tables are built and everything allocated so far is moved out of
+    reach of the garbage collector, whose passes would otherwise write
+    to (and so unshare) the pages of every object.'''
+    if not isinstance(echoes.tree, (TreeIndex, ShardedIndex)):
+        echoes.tree = flattentree(echoes.tree)
+    warmengine(echoes)
+    if hasattr(gc, 'freeze'):
+        gc.collect()
+        gc.freeze()
+
+def serve(args):
+    import argparse
+    import concurrent.futures
+    parser = argparse.ArgumentParser(prog='echoes.py serve',
+        description='Serves lookups over HTTP as JSON.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+        help='worker processes for lookups')
+    parser.add_argument('--timeout', type=float, default=5.0,
+        help='seconds before a lookup is abandoned')
+    parser.add_argument('--prefork', action='store_true',
+        help='load the index once and fork the workers from it, sharing its memory')
+    parser.add_argument('--profiles', default='', metavar='NAMES',
+        help='cost profiles, like nostress,asr, that a request may ask for with profile=NAME')
+    parser.add_argument('--cursors', type=int, default=10000,
+        help='continuations of paged lookups (more=1) to keep at most')
+    parser.add_argument('--cursor-ttl', type=float, default=600, metavar='SECONDS',
+        help='how long to keep each continuation')
+    parser.add_argument('--cursor-memory', type=float, default=64, metavar='MB',
+        help='and no more than about this much memory for them')
+    addlookupoptions(parser)
+    options = parser.parse_args(args)
+    settings = setlookupoptions(parser, options)
+    if options.prefork and 'fork' not in multiprocessing.get_all_start_methods():
+        parser.error('--prefork needs a platform that can fork')
+    profilelocations = dict()
+    for name in filter(None, options.profiles.split(',')):
+        try:
+            profilelocations[name] = profileindex(name)
+        except (ValueError, OSError) as error:
+            parser.error(str(error))
+    serveengines(options.tree, options.distances, settings, list(profilelocations))
+    # the workers sign continuations with it, and serve reads their profile
+    cursorkey = secrets.token_bytes(32)
+    # build the engines' tables before taking requests, which would have
+    # only their time limit to build them in
+    try:
+        for echoes in workerengines.values():
+            with echoes.active():
+                warmengine(echoes)
+    except Exception as error:
+        parser.error('could not set up the {e} engine: {x}'.format(e=settings['engine'], x=error))
+    tree = workerengines[None].tree
+    words = len(tree) if isinstance(tree, (TreeIndex, ShardedIndex)) \
+            else sum(1 for word in treewords(tree))
+    context = None
+    if options.prefork:
+        for echoes in workerengines.values():
+            with echoes.active():
+                prefork(echoes)
+        context = multiprocessing.get_context('fork')
+    executor = concurrent.futures.ProcessPoolExecutor(options.jobs, mp_context=context,
+        initializer=serveworkerinit,
+        initargs=(options.tree, options.distances, settings, list(profilelocations), cursorkey))
+    if options.prefork:
+        # a forking pool starts all its workers on the first task, and
+        # they should be forked before the event loop starts threads
+        executor.submit(os.getpid).result()
+    server = LookupServer(executor, words, options.timeout, profiles=list(profilelocations),
+        cursors=CursorStore(options.cursors, options.cursor_ttl, int(options.cursor_memory * 2**20)),
+        cursorkey=cursorkey)
+    async def run():
+        listener = await asyncio.start_server(server.handle, options.host, options.port)
+        print('serving {w} words on http://{h}:{p}/ with {j} workers'.format(
+            w=words, h=options.host, p=options.port, j=options.jobs))
+        if options.prefork:
+            memory = [worker['unique bytes'] for worker in workermemory()]
+            if None not in memory:
+                print('unique memory per worker: {}'.format(
+                    ', '.join('{:.1f} MB'.format(m / 2**20) for m in memory)))
+        async with listener:
+            await listener.serve_forever()
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+def loadtest(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog='echoes.py loadtest',
+        description='Sends lookups to a running `echoes.py serve\' and reports '
+                    'requests per second and latency.')
+    parser.add_argument('queries', nargs='?',
+        help='file of pronunciations, one per line (default a few examples)')
+    parser.add_argument('--url', default='http://127.0.0.1:8000/')
+    parser.add_argument('-c', '--concurrency', type=int, default=8,
+        help='connections sending requests at the same time')
+    parser.add_argument('-r', '--requests', type=int, default=1000)
+    parser.add_argument('-n', type=int, default=10, help='matches per lookup')
+    options = parser.parse_args(args)
+    if options.queries:
+        f = open(options.queries, encoding='utf-8')
+        prons = [line.strip() for line in f if line.strip()]
+        f.close()
+    else:
+        prons = ['HH AH L OW1', 'SH AE T OW', 'r ae t ah t uw1 iy']
+    url = urllib.parse.urlsplit(options.url)
+    latencies = []
+    statuses = collections.Counter()
+    targets = iter(range(options.requests))
+    async def client():
+        reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+        for i in targets:
+            target = '/lookup?' + urllib.parse.urlencode({'pron': prons[i % len(prons)], 'n': options.n})
+            starttime = time.perf_counter()
+            writer.write('GET {} HTTP/1.1\r\nHost: {}\r\n\r\n'.format(target, url.netloc).encode('latin-1'))
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line == b'\r\n':
+                    break
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - starttime)
+            statuses[status] += 1
+        writer.close()
+    async def run():
+        await asyncio.gather(*(client() for c in range(options.concurrency)))
+    starttime = time.perf_counter()
+    asyncio.run(run())
+    elapsed = time.perf_counter() - starttime
+    latencies.sort()
+    percentile = lambda p: latencies[min(len(latencies)-1, int(p * len(latencies)))]
+    print('{n} requests in {t:.2f} seconds, {c} at a time'.format(
+        n=len(latencies), t=elapsed, c=options.concurrency))
+    print('{r:.1f} requests per second'.format(r=len(latencies) / elapsed))
+    print('latency p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms'.format(
+        1000*percentile(0.5), 1000*percentile(0.99), 1000*latencies[-1]))
+    print('status codes: ' + ', '.join('{}: {}'.format(k, v) for k, v in sorted(statuses.items())))
+
+def perturb(pron, edits, rand, distances):
+    '''pron with `edits' random substitutions, insertions and deletions,
+    a sound being more likely to turn into or appear as one close to
+    it by distances.'''
+    matrix = distances.matrix
+    pron = list(pron)
+    sounds = range(1, PHONECOUNT)
+    for edit in range(edits):
+        kind = rand.choice(['substitute', 'insert', 'delete'] if len(pron) > 1 else ['substitute', 'insert'])
+        if kind == 'delete':
+            del pron[rand.randrange(len(pron))]
+        elif kind == 'insert':
+            pron.insert(rand.randrange(len(pron)+1),
+                        rand.choices(sounds, [1 / max(matrix[0][y], 1) for y in sounds])[0])
+        else:
+            i = rand.randrange(len(pron))
+            others = [y for y in sounds if y != pron[i]]
+            pron[i] = rand.choices(others, [1 / max(matrix[pron[i]][y], 1) for y in others])[0]
+    return pron
+
+def workloads(tree, distances, count, seed=0):
+    '''Query pronunciations for benchmarks, the same for the same tree
+    and seed: words of the tree as they are, with one to three edits,
+    and random sequences of sounds.'''
+    rand = random.Random(seed)
+    if isinstance(tree, (TreeIndex, ShardedIndex)):
+        nodes = rand.sample(range(len(tree)), min(len(tree), 2 * count))
+        prons = [list(tree.pron(node)) for node in nodes]
+    else:
+        words = list(treewords(tree))
+        prons = [list(word.pronna) for word in rand.sample(words, min(len(words), 2 * count))]
+    return collections.OrderedDict([
+        ('exact', prons[:count]),
+        ('edited', [perturb(pron, 1 + i % 3, rand, distances)
+                    for i, pron in enumerate(prons[count:])]),
+        ('random', [[rand.randrange(1, PHONECOUNT) for j in range(rand.randrange(3, 11))]
+                    for i in range(count)])])
+
+def percentiles(times):
+    times = sorted(times)
+    at = lambda p: times[min(len(times)-1, int(p * len(times)))]
+    return {'mean': sum(times) / len(times), 'p50': at(0.5), 'p90': at(0.9),
+            'p99': at(0.99), 'max': times[-1]}
+
+def bench(args):
+    import argparse
+    import platform
+    parser = argparse.ArgumentParser(prog='echoes.py bench',
+        description='Measures lookup latency and throughput on generated queries, '
+                    'index load time, build time and memory, and writes them as JSON.')
+    parser.add_argument('-q', '--queries', type=int, default=50, help='queries per workload')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', default='bench.json')
+    parser.add_argument('--compare', metavar='JSON', help='an earlier output to compare with')
+    parser.add_argument('--dictionary', default=dictionary,
+        help='cmudict-format file to time building a tree from (skipped if missing)')
+    parser.add_argument('--build-words', type=int, default=5000,
+        help='how many of its words to build a tree from')
+    addlookupoptions(parser)
+    options = parser.parse_args(args)
+    echoes = Echoes(options.tree, options.distances, **setlookupoptions(parser, options))
+    engine = echoes.engine
+    results = collections.OrderedDict()
+    results['settings'] = {'engine': engine, 'bulk': echoes.bulk, 'cache': options.cache,
+                           'candidates': echoes.candidates, 'gram': echoes.gramsize,
+                           'beam': echoes.beam,
+                           'queries': options.queries, 'seed': options.seed,
+                           'python': platform.python_version(),
+                           'numpy': None if numpy is None else numpy.__version__,
+                           'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+    starttime = time.perf_counter()
+    echoes.load()
+    loadtime = time.perf_counter() - starttime
+    tree = echoes.tree
+    treefile = echoes.treefile
+    results['index'] = {'file': treefile,
+                        'format': 'sharded' if isinstance(tree, ShardedIndex) else
+                                  'binary' if isinstance(tree, TreeIndex) else 'json',
+                        'bytes': os.path.getsize(treefile), 'load seconds': loadtime}
+    print('loaded {f} in {t:.3f} seconds'.format(f=treefile, t=loadtime))
+    queries = workloads(tree, echoes.distances, options.queries, options.seed)
+    # engines other than the tree walk set up their tables on first use
+    starttime = time.perf_counter()
+    list(searchgenie(echoes, queries['exact'][0], 1))
+    results['index']['setup seconds'] = time.perf_counter() - starttime
+    results['lookups'] = collections.OrderedDict()
+    for name, prons in queries.items():
+        for n in (1, 10):
+            times = []
+            total = QueryStats()
+            recalled = 0
+            for mypron in prons:
+                with instrument(echoes, total):
+                    starttime = time.perf_counter()
+                    found = list(lookupgenie(echoes, mypron, n))
+                    times.append(time.perf_counter() - starttime)
+                if engine in approximateengines:
+                    # matches as near as the n-th nearest count as found
+                    exact = [dist for dist, word in exactmatches(echoes, mypron, n)]
+                    recalled += sum(1 for dist, word in found if exact and dist <= exact[-1]) / max(1, len(exact))
+            figures = percentiles(times)
+            figures['queries per second'] = len(times) / sum(times)
+            if engine == 'tree' and numpy is not None and not isinstance(tree, ShardedIndex):
+                # the same queries searched together, as batch does
+                starttime = time.perf_counter()
+                batchnearest(tree, echoes.distances, prons, n)
+                figures['batched queries per second'] = len(prons) / (time.perf_counter() - starttime)
+            figures['distances per query'] = total.distances / len(times)
+            figures['cells per query'] = total.cells / len(times)
+            if engine in approximateengines:
+                figures['recall'] = recalled / len(prons)
+            results['lookups']['{} top {}'.format(name, n)] = figures
+            print('{w:>14}: p50 {p50:8.2f} ms, p99 {p99:8.2f} ms, {qps:8.1f} per second, '
+                  '{dq:8.0f} distances per query{batched}{recall}'.format(
+                      w='{} top {}'.format(name, n), p50=1000*figures['p50'], p99=1000*figures['p99'],
+                      qps=figures['queries per second'], dq=figures['distances per query'],
+                      batched=', {:.1f} per second batched'.format(figures['batched queries per second'])
+                              if 'batched queries per second' in figures else '',
+                      recall=', recall {:.3f}'.format(figures['recall']) if 'recall' in figures else ''))
+    if os.path.exists(options.dictionary):
+        words = shufflewords(readdictionary(options.dictionary), options.seed)[:options.build_words]
+        starttime = time.perf_counter()
+        root = chooseroot(words, echoes.distances)
+        buildtree(words, [root] + [i for i in range(len(words)) if i != root], echoes.distances,
+                  progress=0)
+        buildtime = time.perf_counter() - starttime
+        results['build'] = {'words': len(words), 'seconds': buildtime,
+                            'words per second': len(words) / buildtime}
+        print('built a tree of {w} words in {t:.2f} seconds'.format(w=len(words), t=buildtime))
+    try:
+        import resource
+        # kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        results['peak memory bytes'] = peak if sys.platform == 'darwin' else peak * 1024
+        print('peak memory {m:.1f} MB'.format(m=results['peak memory bytes'] / 2**20))
+    except ImportError:
+        pass
+    f = open(options.output, 'w')
+    json.dump(results, f, indent=1)
+    f.close()
+    print('results written to {f}'.format(f=options.output))
+    if options.compare:
+        f = open(options.compare)
+        earlier = json.load(f)
+        f.close()
+        print()
+        print('compared with {f} ({e}, {i}):'.format(f=options.compare,
+            e=earlier['settings']['engine'], i=earlier['index']['format']))
+        for name, figures in results['lookups'].items():
+            if name in earlier.get('lookups', {}):
+                before = earlier['lookups'][name]
+                print('{w:>14}: p50 {a:8.2f} -> {b:8.2f} ms ({r:5.2f}x), '
+                      'distances {c:8.0f} -> {d:8.0f}'.format(
+                          w=name, a=1000*before['p50'], b=1000*figures['p50'],
+                          r=before['p50'] / figures['p50'],
+                          c=before['distances per query'], d=figures['distances per query']))
+        print('{w:>14}: {a:8.3f} -> {b:8.3f} seconds'.format(w='index load',
+            a=earlier['index']['load seconds'], b=results['index']['load seconds']))
+
+def exactmatches(echoes, mypron, n):
+    '''searchgenie with the tree engine whatever the engine is, added
+    and removed words counted, to measure the approximate engines by.'''
+    return list(searchgenie(echoes, mypron, n, engine='tree'))
+
+def recall(echoes, prons, beams, ks=(1, 10)):
+    '''For each beam width, the mean time of a graph lookup of prons and
+    the share of its k matches as near as the exact k nearest.'''
+    distances = echoes.distances
+    exact = dict((k, [[dist for dist, word in nearestgenie(echoes.tree, distances, mypron, k)]
+                      for mypron in prons])
+                 for k in ks)
+    figures = collections.OrderedDict()
+    for width in beams:
+        for k in ks:
+            recalled = 0
+            starttime = time.perf_counter()
+            found = [list(graphgenie(neighbourgraph(echoes), distances, mypron, k, None, width))
+                     for mypron in prons]
+            seconds = (time.perf_counter() - starttime) / len(prons)
+            for matches, nearest in zip(found, exact[k]):
+                recalled += sum(1 for dist, word in matches if dist <= nearest[-1]) / len(nearest)
+            figures['beam {} top {}'.format(width, k)] = {'recall': recalled / len(prons),
+                                                         'seconds': seconds}
+    return figures
+
+def graphcommand(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog='echoes.py graph',
+        description='Builds the neighbour graph for --engine graph beside the tree, '
+                    'and reports its recall against the exact tree search.')
+    parser.add_argument('--tree', help='lookup tree (default tree.idx if present, else tree.json)')
+    parser.add_argument('--distances', default='dist.json')
+    parser.add_argument('--degree', type=int, default=16, help='neighbours per word')
+    parser.add_argument('--candidates', type=int, default=200,
+        help='words scored to find the neighbours of each word')
+    parser.add_argument('--levels', type=int, default=2, help='layers above the graph')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+        help='worker processes (1 to build in this process)')
+    parser.add_argument('-q', '--queries', type=int, default=100,
+        help='queries per workload to measure recall with (0 not to)')
+    parser.add_argument('--beams', default='8,32,128', help='beam widths to measure recall at')
+    options = parser.parse_args(args)
+    if numpy is None:
+        parser.error('the neighbour graph needs NumPy')
+    echoes = Echoes(options.tree, options.distances)
+    echoes.load()
+    starttime = time.time()
+    graph = NeighbourGraph.build(echoes.tree, echoes.distances, options.degree, options.candidates,
+                                 options.levels, options.seed, options.jobs)
+    graph.tree = echoes.tree
+    echoes.graph = graph
+    location = echoes.treefile + '.graph.npz'
+    graph.save(location, graphstamp(echoes))
+    print('{n} words linked, with {l} layers above, written to {f} in {t:.1f} seconds'.format(
+        n=len(graph.neighbours), l=len(graph.upper), f=location, t=time.time()-starttime))
+    if options.queries <= 0:
+        return
+    beams = [int(width) for width in options.beams.split(',')]
+    for name, prons in workloads(echoes.tree, echoes.distances, options.queries,
+                                 options.seed).items():
+        for title, figures in recall(echoes, prons, beams).items():
+            print('{w:>8} {t:>16}: recall {r:.3f}, {s:7.2f} ms'.format(
+                w=name, t=title, r=figures['recall'], s=1000*figures['seconds']))
+
+def profile(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog='echoes.py profile',
+        description='Makes or checks the cost profile profiles/NAME.json and builds its '
+                    'tree, for lookups with --profile NAME.')
+    parser.add_argument('name')
+    parser.add_argument('--from', dest='source', metavar='DISTANCES',
+        help='derive the profile from these distances (default the profile itself '
+             'if it exists, else dist.json)')
+    parser.add_argument('--ignore-stress', action='store_true',
+        help='make each stressed vowel 0 from its unstressed one')
+    parser.add_argument('--merge', action='append', default=[], metavar='SOUNDS',
+        help='make these sounds 0 apart, like "AA AO" (may be given again)')
+    parser.add_argument('--repair', action='store_true',
+        help='make the distances a metric: the cheaper way of each pair, and no '
+             'distance more than a way through other sounds')
+    parser.add_argument('--no-build', action='store_true', help='do not build the tree')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+        help='worker processes for the build (1 to build in this process)')
+    options = parser.parse_args(args)
+    establishencoding()
+    location = profilelocation(options.name)
+    source = options.source or (location if os.path.exists(location) else 'dist.json')
+    f = open(source)
+    matrix = json.load(f)
+    f.close()
+    merges = [sounds.split() for sounds in options.merge]
+    if options.ignore_stress:
+        merges.extend([p, p[:-1]] for p in NTOP if p.endswith('1'))
+    for sounds in merges:
+        unknown = [p for p in sounds if p.upper() not in PTON]
+        if unknown:
+            parser.error('unknown sounds: ' + ' '.join(unknown))
+    if options.repair or merges:
+        matrix = [list(row) for row in matrix]
+        if options.repair:
+            for a in range(len(matrix)):
+                matrix[a][a] = 0
+                for b in range(a):
+                    matrix[a][b] = matrix[b][a] = min(matrix[a][b], matrix[b][a])
+        for sounds in merges:
+            for a in sounds:
+                for b in sounds:
+                    matrix[PTON[a.upper()]][PTON[b.upper()]] = 0
+        matrix = closedistances(matrix)
+    try:
+        checkdistances(matrix)
+    except ValueError as error:
+        parser.error('{}: {} (--repair makes it a metric)'.format(source, error))
+    if source != location or options.repair or merges:
+        os.makedirs(profiles, exist_ok=True)
+        f = open(location + '.tmp', 'w')
+        json.dump(matrix, f)
+        f.close()
+        os.replace(location + '.tmp', location)
+        print('cost profile {n} written to {f}'.format(n=options.name, f=location))
+    print('cost profile {n}: digest {d}'.format(n=options.name, d=distancesdigest(matrix)))
+    if not options.no_build:
+        try:
+            treelocation, distlocation = profileindex(options.name, options.jobs)
+        except OSError as error:
+            parser.error('{} (--no-build writes the profile alone)'.format(error))
+        print('tree: {t}'.format(t=treelocation))
+
+commands = {'build': build, 'shard': shard, 'convert': convert, 'graph': graphcommand, 'profile': profile, 'update': update, 'stats': stats, 'batch': batch,
+            'serve': serve, 'loadtest': loadtest, 'bench': bench}
+
+NOTICE = '''    Echoes Copyright (C) 2018 pennzht
     This program comes with ABSOLUTELY NO WARRANTY; for details type `?w'.
     This is free software, and you are welcome to redistribute it
     under certain conditions; type `?c' for details.
@@ -203,19 +3737,9 @@ def main():
 
     Ctrl-C to exit or abort lookup.
 
-''')
-    args = sys.argv[1:]
-    establishencoding()
-    loaddistances("dist.json")
-    f = open("tree.json")
-    global tree
-    tree = jsontotree(json.load(f))
-    f.close()
-    while(True):
-        try:
-            A = input('pronunciation: ')
-            if '?w' in A.lower():
-                print ('''  15. Disclaimer of Warranty.
+'''
+
+WARRANTY = '''  15. Disclaimer of Warranty.
 
   THERE IS NO WARRANTY FOR THE PROGRAM, TO THE EXTENT PERMITTED BY
 APPLICABLE LAW.  EXCEPT WHEN OTHERWISE STATED IN WRITING THE COPYRIGHT
@@ -247,9 +3771,9 @@ an absolute waiver of all civil liability in connection with the
 Program, unless a warranty or assumption of liability accompanies a
 copy of the Program in return for a fee.
 
-''')
-            elif '?c' in A.lower():
-                print ('''  0. Definitions.
+'''
+
+CONDITIONS = '''  0. Definitions.
 
   "This License" refers to version 3 of the GNU General Public License.
 
@@ -519,9 +4043,9 @@ documented (and with an implementation available to the public in
 source code form), and must require no special password or key for
 unpacking, reading or copying.
 
-''')
-            elif '?' in A:
-                print ('''        Phoneme Example Translation
+'''
+
+PRONUNCIATIONKEY = '''        Phoneme Example Translation
         ------- ------- -----------
         AA	odd     AA D
         AE	at	AE T
@@ -563,12 +4087,51 @@ unpacking, reading or copying.
         Z 	zee	Z IY
         ZH	seizure	S IY ZH ER
 
-Type the pronunciation of a word using the above pronunciation key. \nFor example, try `HH AH L OW1', `SH AE T OW', and `r ae t ah t uw1 iy'. \nSeparate different sounds with spaces. \nAppend `1' after a sound to mark as stressed syllable. \nYou can also find the pronunciation key in ./HELP\n\n ''')
+Type the pronunciation of a word using the above pronunciation key. \nFor example, try `HH AH L OW1', `SH AE T OW', and `r ae t ah t uw1 iy'. \nSeparate different sounds with spaces. \nAppend `1' after a sound to mark as stressed syllable. \nYou can also find the pronunciation key in ./HELP\n\n '''
+
+def interact(echoes):
+    '''Looks up the pronunciations typed in with echoes, ten best
+    matches each, until Ctrl-C or the end of the input.  Raises what
+    stops echoes loading.'''
+    print(NOTICE)
+    while(True):
+        try:
+            A = input('pronunciation: ')
+            if '?w' in A.lower():
+                print (WARRANTY)
+            elif '?c' in A.lower():
+                print (CONDITIONS)
+            elif '?' in A:
+                print (PRONUNCIATIONKEY)
             else:
-                mypron = ptons(A.split())
-                lookupbest(mypron, 10)
+                with echoes.active():
+                    lookupbest(echoes, echoes.parse(A), 10)
         except (KeyboardInterrupt, EOFError):
             break
 
-main()
+def main():
+    args = sys.argv[1:]
+    if args and args[0] in commands:
+        commands[args[0]](args[1:])
+        return
+    import argparse
+    parser = argparse.ArgumentParser(prog='echoes.py',
+        description='Look up a word by its pronunciation alone.',
+        epilog='Other commands: {} (see echoes.py <command> -h).'.format(', '.join(commands)))
+    addlookupoptions(parser)
+    options = parser.parse_args(args)
+    settings = lookupsettings(options)
+    try:
+        checksettings(settings)
+    except ValueError as error:
+        parser.error(str(error))
+    # read the tree while the notice is on screen
+    echoes = Echoes(options.tree, options.distances, True, options.profile, **settings)
+    try:
+        interact(echoes)
+    except (ValueError, OSError) as error:
+        parser.error(str(error))
+
+if __name__ == '__main__':
+    main()
 
@@ -0,0 +1,232 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+import echoes
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+SOUNDS = ['M', 'B', 'P', 'N', 'D', 'T', 'K', 'S', 'Z', 'L', 'R',
+          'AH', 'IH', 'AE', 'EH', 'IY', 'OW', 'AH1', 'AE1', 'IY1', 'OW1']
+
+def makedictionary(location, count=150, seed=1):
+    '''A small cmudict-format dictionary of made-up words, some of them
+    sharing a pronunciation, so that lookups have ties.'''
+    rand = random.Random(seed)
+    prons = []
+    for i in range(count):
+        if prons and rand.random() < 0.1:
+            prons.append(rand.choice(prons))
+        else:
+            prons.append([rand.choice(SOUNDS) for j in range(rand.randrange(1, 7))])
+    f = open(location, 'w')
+    for i, pron in enumerate(prons):
+        f.write('w{:03d} {}\n'.format(i, ' '.join(pron)))
+    f.close()
+
+def setUpModule():
+    '''Builds the dictionary, tree and a cost profile in a scratch
+    directory and works in it.'''
+    global scratch
+    global previous
+    previous = os.getcwd()
+    scratch = tempfile.mkdtemp()
+    os.chdir(scratch)
+    shutil.copy(os.path.join(here, 'dist.json'), 'dist.json')
+    os.makedirs('cmudict-master')
+    makedictionary(echoes.dictionary)
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        echoes.build([echoes.dictionary, '-o', 'tree.idx', '-d', 'dist.json', '-j', '1'])
+        echoes.build([echoes.dictionary, '-o', 'tree.json', '-d', 'dist.json', '-j', '1'])
+        echoes.profile(['nostress', '--from', 'dist.json', '--ignore-stress', '-j', '1'])
+        echoes.shard([echoes.dictionary, '-o', 'shards', '-d', 'dist.json', '-n', '3',
+                      '-j', '1'])
+
+def tearDownModule():
+    os.chdir(previous)
+    shutil.rmtree(scratch)
+
+def fulldistance(matrix, A, B):
+    '''The weighted edit distance between A and B, every cell of the
+    matrix filled in.'''
+    row = [0]
+    for y in B:
+        row.append(row[-1] + matrix[0][y])
+    for x in A:
+        newrow = [row[0] + matrix[x][0]]
+        for j, y in enumerate(B):
+            newrow.append(min(newrow[j] + matrix[0][y], row[j+1] + matrix[x][0],
+                              row[j] + matrix[x][y]))
+        row = newrow
+    return row[-1]
+
+class DistanceTest(unittest.TestCase):
+    '''The banded distance against the whole matrix, on made-up costs.'''
+
+    def test_banded(self):
+        rand = random.Random(3)
+        for trial in range(40):
+            sounds = rand.randrange(2, 7)
+            # no cheaper than 1 to insert or delete, or free (every cell in the band)
+            least = rand.choice([0, 1, 1, 2])
+            matrix = [[0] * (sounds + 1) for x in range(sounds + 1)]
+            for x in range(sounds + 1):
+                for y in range(x + 1, sounds + 1):
+                    matrix[x][y] = matrix[y][x] = rand.randrange(least if x == 0 else 0, 6)
+            distances = echoes.Distances(matrix)
+            for pair in range(25):
+                A = [rand.randrange(1, sounds + 1) for i in range(rand.randrange(0, 8))]
+                B = [rand.randrange(1, sounds + 1) for i in range(rand.randrange(0, 8))]
+                full = fulldistance(matrix, A, B)
+                self.assertEqual(distances.distance(A, B), full)
+                for limit in range(0, full + 3):
+                    banded = distances.distance(A, B, limit)
+                    if full <= limit:
+                        self.assertEqual(banded, full, (matrix, A, B, limit))
+                    else:
+                        self.assertGreater(banded, limit, (matrix, A, B, limit))
+
+class NearestTest(unittest.TestCase):
+    '''Each engine's best matches against every word's distance.'''
+
+    engines = [
+        ('tree.idx', {'engine': 'tree'}),
+        ('tree.idx', {'engine': 'tree', 'bulk': True}),
+        ('tree.json', {'engine': 'tree'}),
+        ('tree.idx', {'engine': 'scan'}),
+        ('tree.idx', {'engine': 'pivots', 'pivots': 8}),
+        ('tree.json', {'engine': 'pivots', 'pivots': 8}),
+        ('tree.idx', {'engine': 'trie'}),
+        ('tree.idx', {'engine': 'reversetrie'}),
+        # the approximate engines, made exact by looking at every word
+        ('tree.idx', {'engine': 'ngrams', 'candidates': 1000}),
+        ('tree.idx', {'engine': 'graph', 'beam': 1000}),
+        (os.path.join('shards', 'shards.json'), {'shardjobs': 1}),
+        (os.path.join('shards', 'shards.json'), {'shardjobs': 2}),
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        f = open('dist.json')
+        cls.matrix = json.load(f)
+        f.close()
+        f = open(echoes.dictionary)
+        cls.words = [line.split(None, 1) for line in f]
+        f.close()
+        rand = random.Random(2)
+        # words of the dictionary, and others
+        cls.queries = [rand.choice(cls.words)[1] for i in range(4)] + \
+            [' '.join(rand.choice(SOUNDS) for j in range(rand.randrange(1, 8))) for i in range(6)]
+
+    def brute(self, query):
+        '''Every word and its distance from query, nearest first.'''
+        mypron = echoes.ptons(query.split())
+        return sorted((fulldistance(self.matrix, mypron, echoes.ptons(pron.split())), word)
+                      for word, pron in self.words)
+
+    def check(self, engine, query, n, maxdistance=None):
+        brute = [(dist, word) for dist, word in self.brute(query)
+                 if maxdistance is None or dist <= maxdistance]
+        found = engine.lookup(query, n, maxdistance)
+        distances = [match.distance for match in found]
+        # ties at the end of the list may be broken either way
+        self.assertEqual(distances, [dist for dist, word in brute[:n]], query)
+        self.assertEqual(len({match.word for match in found}), len(found))
+        exact = dict((word, dist) for dist, word in brute)
+        for match in found:
+            self.assertEqual(exact[match.word], match.distance, (query, match))
+
+    def test_engines(self):
+        size = len(self.words)
+        for tree, settings in self.engines:
+            with self.subTest(tree=tree, **settings), \
+                    contextlib.redirect_stderr(io.StringIO()):
+                engine = echoes.Echoes(tree, 'dist.json', **settings)
+                for query in self.queries:
+                    for n in (1, 5, 17, size, size + 10):
+                        self.check(engine, query, n)
+                    self.check(engine, query, 10, 6)
+
+    def test_side_by_side(self):
+        # engines with their own distances, one counting its lookups, don't
+        # see each other's
+        default = echoes.Echoes('tree.idx', 'dist.json')
+        nostress = echoes.Echoes(profile='nostress')
+        nostress.load()
+        alone = [echoes.Echoes(profile='nostress').lookup(query, 5) for query in self.queries]
+        with echoes.instrument(nostress) as stats:
+            for query, matches in zip(self.queries, alone):
+                self.check(default, query, 5)
+                self.assertEqual(nostress.lookup(query, 5), matches)
+        self.assertIsNone(default.distances.stats)
+        counted = stats.distances
+        default.lookup(self.queries[0], 5)
+        self.assertEqual(stats.distances, counted)
+        self.assertGreater(counted, 0)
+
+class ServePagingTest(unittest.TestCase):
+    '''Paged lookups through LookupServer.respond, with a worker process
+    as serve starts them.'''
+
+    def setUp(self):
+        key = b'k' * 32
+        settings = echoes.defaultsettings()
+        self.executor = concurrent.futures.ProcessPoolExecutor(1,
+            initializer=echoes.serveworkerinit,
+            initargs=(os.path.abspath('tree.idx'), os.path.abspath('dist.json'), settings,
+                      ['nostress'], key))
+        self.server = echoes.LookupServer(self.executor, 0, 30, profiles=['nostress'],
+                                          cursors=echoes.CursorStore(), inline=64, cursorkey=key)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def get(self, target):
+        status, body = asyncio.run(self.server.respond(target))
+        self.assertEqual(status, 200, body)
+        return body
+
+    def pages(self, query, n, count):
+        body = self.get('/lookup?{}&n={}&more=1'.format(query, n))
+        matches = body['matches']
+        for page in range(count - 1):
+            body = self.get('/lookup?next={}&n={}'.format(body['next'], n))
+            matches.extend(body['matches'])
+        return matches
+
+    def test_profile_pages(self):
+        # the pages of a profile's lookup go on with the profile, whose
+        # distances differ from the default ones
+        query = 'pron=K+AE1+T&profile=nostress'
+        whole = self.get('/lookup?{}&n=12'.format(query))['matches']
+        self.assertEqual(self.pages(query, 4, 3), whole)
+        default = self.get('/lookup?pron=K+AE1+T&n=12')['matches']
+        self.assertNotEqual(whole, default)
+        self.assertEqual(self.pages('pron=K+AE1+T', 4, 3), default)
+
+    def test_errors(self):
+        # only a continuation that can't go on is gone; a lookup that fails
+        # otherwise (here with a profile the workers have no engine for) is
+        # the server's fault
+        status, body = asyncio.run(self.server.respond('/lookup?next=cAAAA&n=4'))
+        self.assertEqual(status, 410, body)
+        status, body = asyncio.run(self.server.respond('/lookup?next=sAAAA&n=4'))
+        self.assertEqual(status, 410, body)
+        server = echoes.LookupServer(self.executor, 0, 30, profiles=['nostress', 'gone'],
+                                     cursorkey=b'k' * 32)
+        with contextlib.redirect_stderr(io.StringIO()):
+            status, body = asyncio.run(server.respond('/lookup?pron=K+AE1+T&profile=gone'))
+        self.assertEqual(status, 500, body)
+        self.assertIn('error', body)
+        self.get('/lookup?pron=K+AE1+T&profile=nostress')
+
+if __name__ == '__main__':
+    unittest.main()